@@ -0,0 +1,59 @@
+"""
+Compares `parallel_kalman` with `kalman_filter` and `chand_recursion` on a
+long simulated sample.
+
+    python benchmarks/parallel_kalman.py [nobs] [nchunks]
+
+Set NUMBA_NUM_THREADS to control the number of cores used.
+"""
+import sys
+import time
+
+import numpy as np
+
+from scipy.linalg import solve_discrete_lyapunov
+
+from dsge.examples import nkmp
+from dsge.filters import chand_recursion, kalman_filter, parallel_kalman
+
+
+def simulate(CC, TT, RR, QQ, DD, ZZ, nobs, seed=0):
+    rng = np.random.default_rng(seed)
+    ns, neps = RR.shape
+    eps = rng.multivariate_normal(np.zeros(neps), QQ, size=nobs)
+    s = np.zeros(ns)
+    y = np.zeros((nobs, ZZ.shape[0]))
+    for t in range(nobs):
+        s = CC + TT @ s + RR @ eps[t]
+        y[t] = DD + ZZ @ s
+    return y
+
+
+def timeit(f, *args, **kwargs):
+    f(*args, **kwargs)
+    t = time.perf_counter()
+    res = f(*args, **kwargs)
+    return res, time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    nobs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    nchunks = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    model = nkmp.compile_model()
+    p0 = nkmp.p0()
+    CC, TT, RR, QQ, DD, ZZ, HH = [np.ascontiguousarray(x, dtype=float)
+                                  for x in model.system_matrices(p0)]
+    DD = DD.flatten()
+    HH = HH + 1e-4*np.eye(HH.shape[0])
+    A0 = np.zeros(CC.shape)
+    P0 = solve_discrete_lyapunov(TT, RR @ QQ @ RR.T)
+    y = simulate(CC, TT, RR, QQ, DD, ZZ, nobs)
+
+    args = (y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0)
+    lik0, t0 = timeit(chand_recursion, *args)
+    print('chand_recursion  %12.4f  %8.3fs' % (lik0, t0))
+    lik1, t1 = timeit(kalman_filter, *args)
+    print('kalman_filter    %12.4f  %8.3fs' % (lik1, t1))
+    lik2, t2 = timeit(parallel_kalman, *args, nchunks=nchunks)
+    print('parallel_kalman  %12.4f  %8.3fs' % (lik2, t2))
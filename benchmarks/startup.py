@@ -0,0 +1,46 @@
+"""
+Time to the first likelihood evaluation in a fresh process.
+
+    python benchmarks/startup.py [model]
+
+Runs a new interpreter with an empty numba cache, then again with the
+cache filled by the first run.  If `python -m dsge.aot` has been run,
+`chand_recursion` comes from the compiled extension and neither run
+compiles it.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+CHILD = """
+import time
+t = time.perf_counter()
+from dsge.examples import {model} as dsge
+model = dsge.compile_model()
+p0 = dsge.p0()
+t1 = time.perf_counter()
+model.log_lik(p0)
+t2 = time.perf_counter()
+model.log_lik(p0)
+t3 = time.perf_counter()
+print('%8.3fs %8.3fs %8.3fs' % (t1 - t, t2 - t1, t3 - t2))
+"""
+
+
+def run(model, cache_dir):
+    env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c', CHILD.format(model=model)],
+                         env=env, capture_output=True, text=True, check=True)
+    return out.stdout.strip()
+
+
+if __name__ == '__main__':
+    model = sys.argv[1] if len(sys.argv) > 1 else 'nkmp'
+
+    from dsge.StateSpaceModel import aot_filt_choices
+    print('ahead-of-time filters: %s' % ('yes' if aot_filt_choices else 'no'))
+    print('%-12s %9s %9s %9s' % ('', 'setup', '1st lik', '2nd lik'))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        print('%-12s %s' % ('empty cache', run(model, cache_dir)))
+        print('%-12s %s' % ('warm cache', run(model, cache_dir)))
@@ -308,28 +308,7 @@ class DSGE(dict):
         #print ""
         from collections import OrderedDict
         subs_dict = []
-        context = dict([(p.name, p) for p in self.parameters])
-        context['exp'] = sympy.exp
-        context['log'] = sympy.log
-        context_f = {}
-        context_f['exp'] = np.exp
-        if 'helper_func' in self['__data__']['declarations']:
-            from imp import load_source
-            f = self['__data__']['declarations']['helper_func']['file']
-            module = load_source('helper_func', f)
-            for n in self['__data__']['declarations']['helper_func']['names']:
-                context[n] = sympy.Function(n) #getattr(module, n)
-                context_f[n] = getattr(module, n)
-        #import sys
-        #sys.stdout.flush()
-        ss = {}
-
-        for p in self['other_para']:
-            ss[str(p)] = eval(str(self['para_func'][p.name]), context)
-            context[str(p)] = ss[str(p)]
-            #print("\r Constructing substitution dictionary [{0:20s}]".format(p.name),)
-        #sys.stdout.flush()
-        #print ""
+        ss = self._para_func_expressions()
         #context_f['numpy'] = 'numpy'
         GAM0 = lambdify([self.parameters+self['other_para']], GAM0)#, modules={'ImmutableDenseMatrix': np.array})#'numpy')
         GAM1 = lambdify([self.parameters+self['other_para']], GAM1)#, modules={'ImmutableDenseMatrix': np.array})#'numpy')
@@ -366,6 +345,71 @@ class DSGE(dict):
 
         return GAM0, GAM1, PSI, PPI
 
+    def _para_func_expressions(self):
+        """Returns the para_func parameters as expressions in the parameters."""
+        context = dict([(p.name, p) for p in self.parameters])
+        context['exp'] = sympy.exp
+        context['log'] = sympy.log
+        if 'helper_func' in self['__data__']['declarations']:
+            for n in self['__data__']['declarations']['helper_func']['names']:
+                context[n] = sympy.Function(n)
+
+        ss = {}
+        for px in self['other_para']:
+            ss[str(px)] = eval(str(self['para_func'][px.name]), context)
+            context[str(px)] = ss[str(px)]
+
+        return ss
+
+    def python_sims_derivatives(self):
+        """
+        Returns the derivatives of the system matrices with respect to the parameters.
+
+        The derivatives are taken symbolically, with the para_func
+        parameters handled by the chain rule.
+
+        Returns
+        -------
+        derivatives : dict
+            Maps 'GAM0', 'GAM1', 'PSI', 'PPI', 'QQ', 'DD', 'ZZ', 'HH' to
+            functions of the parameter vector returning
+            [npara x nrow x ncol] arrays.
+        """
+        from sympy.utilities.lambdify import lambdify
+
+        matrices = self.python_sims_matrices(matrix_format='symbolic')
+        names = ['GAM0', 'GAM1', 'PSI', 'PPI', 'QQ', 'DD', 'ZZ', 'HH']
+
+        ss = self._para_func_expressions()
+        other_para = self['other_para']
+        dpsi = [[sympy.diff(ss[str(px)], para) for px in other_para]
+                for para in self.parameters]
+
+        args = [self.parameters + other_para]
+        psi = lambdify([self.parameters], [ss[str(px)] for px in other_para])
+
+        derivatives = {}
+        for name, mat in zip(names, matrices):
+            mat = Matrix(mat)
+            dmat_other = [mat.diff(px) for px in other_para]
+            dmat = []
+            for i, para in enumerate(self.parameters):
+                dm = mat.diff(para)
+                for j in range(len(other_para)):
+                    if dpsi[i][j] != 0:
+                        dm = dm + dpsi[i][j]*dmat_other[j]
+                dmat.append(dm)
+
+            f = lambdify(args, dmat)
+
+            def df(px, f=f, shape=mat.shape):
+                res = f([*px, *psi(px)])
+                return np.array([np.asarray(r, dtype=float).reshape(shape) for r in res])
+
+            derivatives[name] = df
+
+        return derivatives
+
     def compile_model(self):
         self.python_sims_matrices()
 
@@ -399,7 +443,8 @@ class DSGE(dict):
                                shock_names=list(map(str, self.shocks)),
                                state_names=list(map(str, self.variables+self['fvars'])),
                                obs_names=list(map(str, self['observables'])),
-                               prior=pri(prior))
+                               prior=pri(prior),
+                               derivatives=self.python_sims_derivatives)
 
         return dsge
 
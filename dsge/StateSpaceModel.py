@@ -4,19 +4,158 @@ A module for Linear Gaussian State Space models.
 
 Classes
 -------
+FilterState
 StateSpaceModel
 LinearDSGEModel
 """
+import copy
+
 import numpy as np
 import pandas as p
 
-from scipy.linalg import solve_discrete_lyapunov
+from collections import OrderedDict
+from collections.abc import Iterator
+
+from scipy.linalg import solve_discrete_lyapunov, schur
+from scipy.special import ndtr
 
-from .gensys import gensys
+from .gensys import gensys, gensys_derivative
 from .filters import chand_recursion, kalman_filter, filter_and_smooth
+from .filters import sqrt_kalman, univariate_kalman
+from .filters import chand_kalman, _chand_kalman, missing_pattern
+from .filters import kalman_filter_grad
+from .filters import chand_recursion_batch, kalman_filter_batch, chand_kalman_batch
+from .filters import simulation_smoother, simulate_paths
+from .filters import disturbance_smoother, shock_decomposition, triangular_resolvent
+from .filters import conditional_smoother
+from .filters import parallel_kalman, collapse_observations, minimal_realization
+from .filters import lyapunov_fast, _cholpsd
+from . import aot
 
 filt_choices = {'chand_recursion': chand_recursion,
-                'kalman_filter': kalman_filter}
+                'kalman_filter': kalman_filter,
+                'sqrt_kalman': sqrt_kalman,
+                'univariate_kalman': univariate_kalman,
+                'chand_kalman': chand_kalman,
+                'parallel_kalman': parallel_kalman}
+
+# ahead-of-time compiled filters, if `python -m dsge.aot` has been run
+aot_filt_choices = aot.load()
+
+batch_filt_choices = {'chand_recursion': chand_recursion_batch,
+                      'kalman_filter': kalman_filter_batch,
+                      'chand_kalman': chand_kalman_batch}
+
+
+def _rng(seed=None):
+    """
+    Returns a numpy Generator from an int, SeedSequence or Generator.  Without
+    a seed, the generator is seeded from the global numpy random state, so
+    `np.random.seed` still makes results reproducible.
+    """
+    if seed is None:
+        seed = np.random.randint(2**63 - 1, dtype=np.int64)
+    return np.random.default_rng(seed)
+
+
+def _mixture_quantiles(mu, sd, q, tol=1e-10):
+    """
+    Quantiles of the equally weighted mixture of normals N(mu[i], sd[i]^2),
+    for each element of the trailing dimensions, by bisection.
+
+    mu, sd : [nmix x ...] arrays, q : 1d array of probabilities.
+    Returns a [len(q) x ...] array.
+    """
+    sd = np.maximum(sd, 1e-300)
+    q = np.asarray(q, dtype=float).reshape((-1,) + (1,)*(mu.ndim-1))
+
+    lo = np.broadcast_to((mu - 10*sd).min(0), (q.shape[0],) + mu.shape[1:]).copy()
+    hi = np.broadcast_to((mu + 10*sd).max(0), lo.shape).copy()
+    for _ in range(200):
+        x = 0.5*(lo + hi)
+        below = ndtr((x[:, None] - mu) / sd).mean(1) < q
+        lo = np.where(below, x, lo)
+        hi = np.where(below, hi, x)
+        if np.max(hi - lo) < tol * max(1.0, np.max(np.abs(x))):
+            break
+    return 0.5*(lo + hi)
+
+
+class FilterState(object):
+    """
+    The state of the Kalman filter after the last observation, which
+    `StateSpaceModel.update` advances with new observations.
+
+    Attributes
+    ----------
+    system : tuple
+        The system matrices (CC, TT, RR, QQ, DD, ZZ, HH).
+    At, Pt : np.array
+        The mean and covariance of the states in the period after the
+        last observation, given all the observations.
+    Ft, iFt, Kt, St, Mt, chand :
+        The quantities of the Chandrasekhar recursion, see `chand_kalman`.
+    loglh : float
+        The log likelihood of the observations so far.
+    nobs : int
+        The number of observations so far.
+    lag : int
+        The length of the window of the fixed lag smoother.
+    window : list
+        (At, Pt, y) for each of the last `lag` periods, with At and Pt the
+        prediction of the states before y was observed.
+    """
+
+    def __init__(self, system, A0, P0, lag=4):
+        ns = system[1].shape[0]
+        ny = system[5].shape[0]
+
+        self.system = system
+        self.At = A0.copy()
+        self.Pt = P0.copy()
+        self.Ft = np.zeros((ny, ny))
+        self.iFt = np.zeros((ny, ny))
+        self.Kt = np.zeros((ns, ny))
+        self.St = np.zeros((ns, ny))
+        self.Mt = np.zeros((ny, ny))
+        self.chand = False
+
+        self.loglh = 0.0
+        self.nobs = 0
+        self.lag = lag
+        self.window = []
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def advance(self, y, t0=0, pattern=None):
+        """
+        Runs the filter over the rows of y, in place.  pattern, the output 
+        of `missing_pattern(y)`, is computed if not given.
+        """
+        y = np.ascontiguousarray(np.atleast_2d(y), dtype=float)
+        nobs = y.shape[0]
+
+        # only the last `lag` periods go through one at a time
+        split = max(nobs - self.lag, 0)
+        self._run(y[:split], t0, pattern if split == nobs else None)
+        for i in range(split, nobs):
+            self.window.append((self.At.copy(), self.Pt.copy(), y[i].copy()))
+            self._run(y[i:i+1], max(t0 - i, 0))
+        self.window = self.window[-self.lag:] if self.lag > 0 else []
+
+        self.nobs += nobs
+
+    def _run(self, y, t0, pattern=None):
+        if y.shape[0] == 0:
+            return
+
+        pattern, index, nact = missing_pattern(y) if pattern is None else pattern
+        (loglh, self.At, self.Pt, self.Ft, self.iFt, self.Kt, self.St, self.Mt,
+         self.chand) = _chand_kalman(y, *self.system, self.At, self.Pt, self.Ft, self.iFt,
+                                     self.Kt, self.St, self.Mt, self.chand,
+                                     pattern, index, nact, t0)
+        self.loglh += loglh
 
 
 class StateSpaceModel(object):
@@ -57,13 +196,48 @@ class StateSpaceModel(object):
         Define the observable transition matrices as function of a parameter vector.
     log_lik(para)
         Computes the likelihood of the model at parameter value para.
+    log_lik_batch(paras)
+        Computes the likelihood of the model at each row of paras.
     impulse_response(para, h=20)
         Computes the impulse response function at parameter value para.
+    impulse_response_batch(draws, h=20)
+        Computes the impulse response functions at each row of draws.
+    variance_decomposition(para, horizons=(1, 4, 8, 20, 40))
+        Computes the forecast error variance decomposition at parameter value para.
+    variance_decomposition_batch(draws, horizons=(1, 4, 8, 20, 40))
+        Computes the forecast error variance decomposition at each row of draws.
+    moments(para, maxlag=4)
+        Computes the population means and autocovariances at parameter value para.
+    moments_batch(draws, maxlag=4)
+        Computes the population autocovariances at each row of draws.
+    spectrum(para, freqs=None)
+        Computes the spectral density of the observables at parameter value para.
+    spectrum_batch(draws, freqs=None)
+        Computes the spectral density of the observables at each row of draws.
+    historical_decomposition(para)
+        Decomposes the smoothed states or the data into the contributions of the shocks.
+    historical_decomposition_batch(draws)
+        Computes the historical decomposition at each row of draws.
     pred(para, h=20, shocks=True, append=False)
         Simulates a draw from the predictive distribution at parameter
         value para.
+    pred_batch(draws, h=20, nsim_per_draw=1, quantiles=None)
+        Simulates from, or computes the quantiles of, the predictive 
+        distribution over a collection of parameter values.
+    update(state, new_rows)
+        Advances a filter state returned with `return_state=True` by new observations.
+    fixed_lag_smoother(state)
+        Smooths the states of the last periods of a filter state.
+    chunks(yy=None, chunksize=10000)
+        Iterates over blocks of the data, with their cached missing data patterns.
+    conditional_forecast(para, conditions, h=None)
+        Forecasts the observables given the data and assumed paths for some of them.
+    conditional_forecast_batch(draws, conditions, h=None)
+        Conditional forecasts at each row of draws, for several scenarios.
     kf_everything(para)
         Generates the filtered and smoothed posterior means of the state vector.
+    simulation_smoother(para, ndraws=1)
+        Draws the states and shocks from their distribution conditional on the data.
     """
 
     fast_filter = 'chand_recursion'
@@ -106,12 +280,78 @@ class StateSpaceModel(object):
         P0 : 2d array-like or string, optional
             [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
             associated with the invariant distribution.  The default is `unconditional.`
+            `unconditional_fast` computes the same matrix with `lyapunov_fast`.
+        filter : string, optional
+            One of the keys of `filt_choices`, or `whittle`. The default is `chand_recursion`,
+            or `chand_kalman` if the data contain missing observations (`kalman_filter`
+            if ss_tol is also given).
+        ss_tol : float, optional
+            Tolerance on the change in the Kalman gain below which the filter
+            switches to its steady state, freezing the gain and the forecast error
+            covariance for the remaining periods.  Only supported by `chand_recursion`
+            and `kalman_filter`; by default the filter never switches.
+        nchunks : int, optional
+            Number of chunks the sample is split into by `parallel_kalman`.
+            The default is the number of numba threads.
+        collapse : bool, optional
+            If True, the observables are first collapsed onto a system of 
+            dimension rank(ZZ) <= ns, so the filter runs at the cost of the 
+            state dimension when there are more observables than states.  
+            Requires HH positive definite and no missing observations.
+            The default is False.
+        reduce : bool or 'auto', optional
+            Run the filter on the minimal (controllable and observable)
+            realization of the state space system, which gives the same likelihood
+            with fewer states.  With `auto` (the default), the minimal realization
+            is computed for each parameter vector and used when it has fewer
+            states than the model; False never reduces.
+        band : tuple, optional
+            With `filter='whittle'`, only the Fourier frequencies in [band[0], band[1]],
+            a subset of [0, pi], enter the likelihood.
+        nbins : int, optional
+            With `filter='whittle'`, the periodogram is averaged over this many 
+            bins of adjacent frequencies, and the spectral density is evaluated 
+            once per bin, so the cost of an evaluation no longer grows with T.
+            By default every Fourier frequency is used.
+        return_state : bool, optional
+            Also return the `FilterState` after the last observation, which
+            `update` advances with new observations.  The state is computed
+            with `chand_kalman`; other filters, ss_tol and nchunks raise a 
+            ValueError.  The default is False.
+        lag : int, optional
+            The window of the fixed lag smoother kept in the state.  The default is 4.
+        chunksize : int, optional
+            Run the filter over blocks of this many observations, carrying its
+            state from one block to the next, so only one block of the data 
+            is in memory at a time.  This is the default, with 10000 rows, 
+            when y is a `numpy.memmap`.  y may also be an iterator of 
+            [n x ny] blocks.  See `chunks`.  Chunked data are filtered with
+            `chand_kalman`; other filters, ss_tol and nchunks raise a ValueError.
 
 
         Returns
         -------
         lik : float
             The log likelihood.
+        state : FilterState
+            Only if return_state is True.  None if the model has no solution.
+
+
+        Notes
+        -----
+        `filter='whittle'` gives the frequency domain (Whittle) approximation 
+
+        .. math::
+
+        -\\frac{1}{2}\\sum_j \\left[\\log\\det 2\\pi f(\\omega_j) 
+        + \\mathrm{tr}\\left(f(\\omega_j)^{-1} I(\\omega_j)\\right)\\right] + const.
+
+        over the Fourier frequencies, where I is the periodogram of the data.  
+        The discrete Fourier transform of the data is computed once and cached.
+        It requires data without missing observations.  The zero frequency
+        carries the information about the mean; when the spectral density is
+        singular there, e.g. for observables in first differences of
+        cointegrated series, exclude it with `band`.
 
 
         See Also
@@ -124,32 +364,348 @@ class StateSpaceModel(object):
         yy = kwargs.pop('y', self.yy)
         P0 = kwargs.pop('P0', 'unconditional')
 
-
-        if np.isnan(yy).any().any():
-            default_filter = 'kalman_filter'
+        filt_kwargs = {'t0': t0}
+        if 'ss_tol' in kwargs:
+            filt_kwargs['ss_tol'] = kwargs.pop('ss_tol')
+        if 'nchunks' in kwargs:
+            filt_kwargs['nchunks'] = kwargs.pop('nchunks')
+        collapse = kwargs.pop('collapse', False)
+        reduce = kwargs.pop('reduce', 'auto')
+        band = kwargs.pop('band', None)
+        nbins = kwargs.pop('nbins', None)
+        return_state = kwargs.pop('return_state', False)
+        lag = kwargs.pop('lag', 4)
+        chunksize = kwargs.pop('chunksize', None)
+
+        stream = (chunksize is not None or isinstance(yy, (np.memmap, Iterator)))
+        if not stream and not hasattr(yy, 'shape'):
+            yy = np.asarray(yy, dtype=float)
+        if stream or return_state:
+            if kwargs.get('filter', 'chand_kalman') != 'chand_kalman' or len(filt_kwargs) > 1:
+                raise ValueError('return_state and chunked data are only filtered with '
+                                 'chand_kalman, without ss_tol or nchunks')
+            default_filter = 'chand_kalman'
         else:
-            default_filter = 'chand_recursion'
+            default_filter = self._default_filter(yy, 'ss_tol' in filt_kwargs)
 
         filt = kwargs.pop('filter', default_filter)
-        filt_func = filt_choices[filt]
+        filt_func = filt_choices[filt] if filt != 'whittle' else None
+        if 'ss_tol' in filt_kwargs and filt not in ('chand_recursion', 'kalman_filter'):
+            raise ValueError('ss_tol is only supported by chand_recursion and kalman_filter')
+        if filt == 'chand_kalman' and not stream:
+            filt_kwargs['pattern'] = self.missing_pattern(yy)
 
         CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para)
         A0 = kwargs.pop('A0', np.zeros(CC.shape))
         if (np.isnan(TT)).any():
             lik = -1000000000000.0
+            return (lik, None) if return_state else lik
+
+        if return_state or stream:
+            if reduce is True or collapse or filt == 'whittle':
+                raise ValueError('return_state and chunked data cannot be combined '
+                                 'with reduce, collapse or whittle')
+            if stream:
+                state = self._filter_state_chunked(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0,
+                                                   t0, lag if return_state else 0,
+                                                   chunksize or 10000)
+            else:
+                state = self._filter_state(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0, lag)
+            return (state.loglh, state) if return_state else state.loglh
+
+        if filt == 'whittle':
+            return self._whittle_log_lik(yy, CC, TT, RR, QQ, DD, ZZ, HH, t0, band, nbins)
+
+        if reduce:
+            V, CCr, TTr, RRr, ZZr, A0r, P0r = minimal_realization(
+                CC, TT, RR, np.asarray(ZZ, dtype=float), A0,
+                None if isinstance(P0, str) else P0)
+            if reduce is True or V.shape[1] < V.shape[0]:
+                CC, TT, RR, ZZ, A0 = CCr, TTr, RRr, ZZr, A0r
+                P0 = P0 if P0r is None else P0r
+
+        # the square root filter can take a factor of the unconditional P0
+        factor = filt == 'sqrt_kalman' and isinstance(P0, str)
+        if factor:
+            filt_kwargs['P0_is_factor'] = True
+        P0 = self.initial_covariance(TT, RR, QQ, P0, factor=factor)
+
+        correction = 0.0
+        if collapse:
+            yy, DD, ZZ, HH, correction = collapse_observations(yy, DD, ZZ, HH, t0=t0)
+            filt_kwargs.pop('pattern', None)
+
+        # the same dtypes and layouts every call, so the filters are compiled once
+        filt_func = aot_filt_choices.get(filt, filt_func)
+        lik = filt_func(*self._filter_inputs(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0),
+                        **filt_kwargs)
+        return lik + correction
+
+    def _default_filter(self, yy, ss_tol=False):
+        """
+        Returns `chand_recursion` for complete data; otherwise `chand_kalman`, 
+        or `kalman_filter` if the steady state switch is requested.
+        """
+        if not np.isnan(np.asarray(yy, dtype=float)).any():
+            return 'chand_recursion'
+        return 'kalman_filter' if ss_tol else 'chand_kalman'
+
+    @staticmethod
+    def _filter_inputs(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0):
+        """
+        Converts the data and system matrices to float64, C-contiguous arrays,
+        with CC, DD and A0 one dimensional and the rest two dimensional.
+        """
+        yy = np.asarray(yy, dtype=float)
+        if yy.ndim < 2:
+            yy = yy[:, np.newaxis]
+
+        CC, DD, A0 = [np.ascontiguousarray(np.ravel(x), dtype=float) for x in (CC, DD, A0)]
+        TT, RR, QQ, ZZ, HH, P0 = [np.ascontiguousarray(np.atleast_2d(x), dtype=float)
+                                  for x in (TT, RR, QQ, ZZ, HH, P0)]
+        return np.ascontiguousarray(yy), CC, TT, RR, QQ, DD, ZZ, HH, A0, P0
+
+    def log_lik_batch(self, paras, *args, **kwargs):
+        """
+        Computes the log likelihood of the model for a collection of parameters.
+
+        The model is solved for every parameter vector, the resulting
+        systems are stacked, and a single call to a batched filter
+        evaluates all of the likelihoods.
+
+        Parameters
+        ----------
+        paras : 2d array-like
+            An [ndraws x npara] array of parameter values.
+        t0 : int, optional
+            Number of initial observations to condition on.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        P0 : 2d array-like or string, optional
+            [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
+            associated with the invariant distribution.  The default is `unconditional.`
+            `unconditional_fast` computes the same matrix with `lyapunov_fast`.
+        ss_tol : float, optional
+            Tolerance for switching to the steady state filter, see `log_lik`.
+        filter : string, optional
+            One of the keys of `batch_filt_choices`, with the same default as `log_lik`.
+
+        Returns
+        -------
+        lik : np.array (ndraws)
+            The log likelihoods.
+
+        See Also
+        --------
+        StateSpaceModel.log_lik
+        """
+        t0 = kwargs.pop('t0', self.t0)
+        yy = kwargs.pop('y', self.yy)
+        P0 = kwargs.pop('P0', 'unconditional')
+        ss_tol = kwargs.pop('ss_tol', 0.0)
+
+        filt = kwargs.pop('filter', self._default_filter(yy, ss_tol > 0.0))
+        filt_func = batch_filt_choices[filt]
+        filt_kwargs = {'t0': t0}
+        if filt == 'chand_kalman':
+            if ss_tol > 0.0:
+                raise ValueError('ss_tol is only supported by chand_recursion and kalman_filter')
+            filt_kwargs['pattern'] = self.missing_pattern(yy)
+        else:
+            filt_kwargs['ss_tol'] = ss_tol
+
+        paras = np.atleast_2d(paras)
+        ndraws = paras.shape[0]
+
+        lik = -1000000000000.0*np.ones(ndraws)
+        valid = np.zeros(ndraws, dtype=bool)
+        systems = []
+        for i in range(ndraws):
+            CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(paras[i])
+            if (np.isnan(TT)).any():
+                continue
+
+            A0i = kwargs.get('A0', np.zeros(CC.shape))
+            P0i = self.initial_covariance(TT, RR, QQ, P0)
+
+            ny = ZZ.shape[0]
+            systems.append((CC, TT, RR, QQ,
+                            np.asarray(DD, dtype=float).reshape(ny),
+                            np.asarray(ZZ, dtype=float),
+                            np.asarray(HH, dtype=float).reshape(ny, ny),
+                            np.asarray(A0i, dtype=float),
+                            np.asarray(P0i, dtype=float)))
+            valid[i] = True
+
+        if not valid.any():
             return lik
 
-        if P0=='unconditional':
-            P0 = solve_discrete_lyapunov(TT, RR.dot(QQ).dot(RR.T))
+        CC, TT, RR, QQ, DD, ZZ, HH, A0, P0 = [np.ascontiguousarray(np.stack(x), dtype=float)
+                                              for x in zip(*systems)]
+
+        lik[valid] = filt_func(np.ascontiguousarray(yy, dtype=float),
+                               CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, **filt_kwargs)
+        return lik
+
+    def missing_pattern(self, yy=None):
+        """
+        Returns the missing data pattern of yy (see `filters.missing_pattern`).
+
+        The pattern of the last dataset is cached, keyed on the positions of
+        its missing observations, so only the scan for NaNs runs again when
+        the same data (or data with the same NaNs) are passed.
+        """
+        if yy is None:
+            yy = self.yy
+
+        y = np.asarray(yy, dtype=float)
+        missing = np.isnan(y)
+
+        cached = getattr(self, '_missing_pattern', None)
+        if cached is None or not np.array_equal(cached[0], missing):
+            cached = (missing, missing_pattern(y))
+            self._missing_pattern = cached
+
+        return cached[1]
+
+    def fourier_transform(self, yy=None, t0=0, band=None, nbins=None):
+        """
+        Returns the discrete Fourier transform of the data, as used by the
+        Whittle likelihood.  For the observable set passed during class
+        instantiation it is computed once and cached.
+
+        Parameters
+        ----------
+        yy : 2d array-like, optional
+            Dataset of observables (T x nobs).
+        t0 : int, optional
+            Number of initial observations to drop.
+        band : tuple, optional
+            Keep only the frequencies in [band[0], band[1]].
+        nbins : int, optional
+            Average the periodogram over this many bins of adjacent frequencies.
 
-        lik = filt_func(np.asarray(yy), CC, TT, RR, QQ,
-                        np.asarray(DD, dtype=float),
-                        np.asarray(ZZ, dtype=float),
-                        np.asarray(HH, dtype=float),
-                        np.asarray(A0, dtype=float),
-                        np.asarray(P0, dtype=float), t0=t0)
+        Returns
+        -------
+        T : int
+            The number of observations.
+        ysum : np.array (ny)
+            The sum of the observations, from which the zero frequency term
+            is recomputed for each mean.
+        freqs : np.array (nfreq)
+            The frequencies, or bin centers.  The zero frequency, if in the
+            band, is first.
+        weights : np.array (nfreq)
+            The number of Fourier frequencies in [0, 2 pi) each entry stands for.
+        dft : np.array (nfreq x ny x ny), complex
+            The sum over those frequencies of d_j d_j^* / T, where d_j is the
+            Fourier transform of the data; zero at the zero frequency.
+        """
+        if yy is None:
+            yy = self.yy
+
+        key = (t0, None if band is None else tuple(band), nbins)
+        cached = getattr(self, '_fourier_transform', None)
+        if yy is self.yy and cached is not None and cached[0] is self.yy and cached[1] == key:
+            return cached[2]
+
+        y = np.asarray(p.DataFrame(yy), dtype=float)[t0:]
+        if np.isnan(y).any():
+            raise ValueError('The Whittle likelihood requires data without missing observations.')
+
+        T = y.shape[0]
+        j = np.arange(T//2 + 1)
+        freqs = 2*np.pi*j/T
+        weights = np.where((j == 0) | (2*j == T), 1.0, 2.0)
+        d = np.fft.fft(y, axis=0)[:j.size]
+        dft = weights[:, None, None] * d[:, :, None] * d[:, None, :].conj() / T
+        dft[0] = 0.0
+
+        if band is not None:
+            keep = (freqs >= band[0]) & (freqs <= band[1])
+            freqs, weights, dft = freqs[keep], weights[keep], dft[keep]
+
+        if nbins is not None:
+            # the zero frequency stays on its own, as it depends on the mean
+            zero = freqs.size > 0 and freqs[0] == 0
+            groups = np.array_split(np.arange(int(zero), freqs.size), nbins)
+            groups = ([np.array([0])] if zero else []) + [g for g in groups if g.size > 0]
+            freqs = np.array([np.average(freqs[g], weights=weights[g]) for g in groups])
+            dft = np.array([dft[g].sum(0) for g in groups])
+            weights = np.array([weights[g].sum() for g in groups])
+
+        result = (T, y.sum(0), freqs, weights, dft)
+        if yy is self.yy:
+            self._fourier_transform = (self.yy, key, result)
+        return result
+
+    def _whittle_log_lik(self, yy, CC, TT, RR, QQ, DD, ZZ, HH, t0=0, band=None, nbins=None):
+        """
+        The Whittle log likelihood; see `log_lik`.
+        """
+        T, ysum, freqs, weights, dft = self.fourier_transform(yy, t0, band, nbins)
+        ny = ysum.size
+
+        F = self._spectral_density(TT, RR, QQ, ZZ, HH, np.exp(-1j*freqs))
+
+        if freqs.size > 0 and freqs[0] == 0:
+            mu = np.ravel(DD) + np.atleast_2d(ZZ) @ np.linalg.solve(
+                np.eye(TT.shape[0]) - TT, np.ravel(CC))
+            d0 = ysum - T*mu
+            dft = dft.copy()
+            dft[0] = np.outer(d0, d0) / T
+
+        sign, logdet = np.linalg.slogdet(F)
+        if (sign.real <= 0).any():
+            return -1000000000000.0
+
+        quad = np.trace(np.linalg.solve(F, dft), axis1=1, axis2=2).real
+        lik = -0.5*(np.sum(weights*(ny*np.log(2*np.pi) + logdet.real)) + quad.sum())
         return lik
 
+    def initial_covariance(self, TT, RR, QQ, P0='unconditional', factor=False):
+        """
+        Returns the initial covariance matrix of the states.
+
+        Parameters
+        ----------
+        TT, RR, QQ : 2d array-like
+            The state transition matrices.
+        P0 : 2d array-like or string, optional
+            [ns x ns] covariance matrix, which is returned as is, `unconditional`
+            for the covariance of the invariant distribution, or 
+            `unconditional_fast` for the same computed with `lyapunov_fast`, warm 
+            started at the last solution of the same size.  The default is 
+            `unconditional`.
+        factor : bool, optional
+            Return a lower triangular S with P0 = SS' instead.  The default is False.
+
+        Returns
+        -------
+        P0 : np.array (ns x ns)
+        """
+        if isinstance(P0, str):
+            RQR = RR.dot(QQ).dot(RR.T)
+            if P0 == 'unconditional':
+                P0 = solve_discrete_lyapunov(TT, RQR)
+            elif P0 == 'unconditional_fast':
+                warm = getattr(self, '_P0_warm', None)
+                if warm is None or warm.shape != TT.shape:
+                    warm = np.zeros(TT.shape)
+
+                P0, converged = lyapunov_fast(np.ascontiguousarray(TT, dtype=float),
+                                              np.ascontiguousarray(RQR, dtype=float), warm)
+                if not converged or not np.isfinite(P0).all():
+                    P0 = solve_discrete_lyapunov(TT, RQR)
+                else:
+                    self._P0_warm = P0
+            else:
+                raise ValueError("P0 must be an array, 'unconditional' or 'unconditional_fast'")
+
+        P0 = np.asarray(P0, dtype=float)
+        return _cholpsd(np.ascontiguousarray(P0)) if factor else P0
+
     def kf_everything(self, para, *args, **kwargs):
         """
         Runs the kalman filter and returns objects of interest.
@@ -166,6 +722,23 @@ class StateSpaceModel(object):
         P0 : 2d arry-like or string, optional
             [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
             associated with the invariant distribution.  The default is `unconditional.`
+            `unconditional_fast` computes the same matrix with `lyapunov_fast`.
+        output : str, optional
+            `means` -- only the means of the states,
+            `stds` -- the means and the stds of the states (default),
+            `cov` -- the means, stds and the full [nobs x ns x ns] covariances.
+            The covariance arrays are only stored when requested, so `means`
+            and `stds` use considerably less memory for large models.
+        reduce : bool or 'auto', optional
+            Run the filter and smoother on the controllable part of the state
+            vector and map the results back to the original states.  With `auto`
+            (the default), this is done when the controllable part is smaller
+            than the state vector; False never reduces.
+        return_state : bool, optional
+            Also return the `FilterState` after the last observation, as
+            `filter_state`.  The default is False.
+        lag : int, optional
+            The window of the fixed lag smoother kept in the state.  The default is 4.
 
 
         Returns
@@ -178,6 +751,10 @@ class StateSpaceModel(object):
              `forecast_std' -- the forecasted stds of the states
              `smoothed_means' -- the smoothed means of the model
              `smoothed_stds' -- the smoothed stds of the model 
+             The stds are omitted when `output='means'`.  When `output='cov'`,
+             `filtered_cov`, `forecast_cov` and `smoothed_cov` are included 
+             as [nobs x ns x ns] arrays.  With `return_state`, `filter_state`
+             is the `FilterState`.
 
         Notes
         -----
@@ -187,19 +764,52 @@ class StateSpaceModel(object):
         t0 = kwargs.pop('t0', self.t0)
         yy = kwargs.pop('y', self.yy)
         P0 = kwargs.pop('P0', 'unconditional')
+        output = kwargs.pop('output', 'stds')
+        reduce = kwargs.pop('reduce', 'auto')
+        return_state = kwargs.pop('return_state', False)
+        lag = kwargs.pop('lag', 4)
         yy = p.DataFrame(yy)
 
+        output_choices = {'means': 0, 'stds': 1, 'cov': 2}
+        if output not in output_choices:
+            raise ValueError("output must be one of %s" % list(output_choices))
+
         CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
         A0 = kwargs.pop('A0', np.zeros(CC.shape))
-        if P0 == 'unconditional':
-            P0 = solve_discrete_lyapunov(TT, RR.dot(QQ).dot(RR.T))
+        if return_state:
+            state = self._filter_state(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0, lag)
+
+        if reduce:
+            V, CCr, TTr, RRr, ZZr, A0r, P0r = minimal_realization(
+                CC, TT, RR, np.asarray(ZZ, dtype=float), A0,
+                None if isinstance(P0, str) else P0, observable=False)
+            reduce = reduce is True or V.shape[1] < V.shape[0]
+        if reduce:
+            CC, TT, RR, ZZ, A0 = CCr, TTr, RRr, ZZr, A0r
+            P0 = P0 if P0r is None else P0r
+            filt_output = output_choices['means' if output == 'means' else 'cov']
+        else:
+            filt_output = output_choices[output]
 
-        res = filter_and_smooth(np.asarray(yy), CC, TT, RR, QQ,
-                                np.asarray(DD, dtype=float),
-                                np.asarray(ZZ, dtype=float),
-                                np.asarray(HH, dtype=float),
-                                np.asarray(A0, dtype=float),
-                                np.asarray(P0, dtype=float), t0=t0)
+        P0 = self.initial_covariance(TT, RR, QQ, P0)
+
+        smoother = aot_filt_choices.get('filter_and_smooth', filter_and_smooth)
+        res = smoother(*self._filter_inputs(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0),
+                       t0=t0, output=filt_output)
+
+        if reduce:
+            # s_t = V s^c_t
+            means = [x @ V.T for x in res[1::3]]
+            if output == 'cov':
+                covs = [V @ x @ V.T for x in res[3::3]]
+                stds = [np.sqrt(np.abs(np.diagonal(x, axis1=1, axis2=2))) for x in covs]
+            else:
+                # diag(V P V') from the reduced covariances, without forming V P V'
+                stds = [np.sqrt(np.abs(np.einsum('ij,tjk,ik->ti', V, x, V))) for x in res[3::3]]
+                covs = [x[:0] for x in res[3::3]]
+            res = [res[0]]
+            for mean, std, cov in zip(means, stds, covs):
+                res += [mean, std, cov]
 
         (loglh, filtered_means, filtered_stds, filtered_cov,
          forecast_means, forecast_stds, forecast_cov,
@@ -216,11 +826,205 @@ class StateSpaceModel(object):
                              ('smoothed_means', smoothed_means),
                              ('smoothed_stds',  smoothed_stds)]:
 
+            if res.shape[0] == 0:
+                continue
             resdf = p.DataFrame(res, columns=self.state_names, index=yy.index)
             results[resname] = resdf
 
+        if output == 'cov':
+            results['filtered_cov'] = filtered_cov
+            results['forecast_cov'] = forecast_cov
+            results['smoothed_cov'] = smoothed_cov
+
+        if return_state:
+            results['filter_state'] = state
+
         return results
 
+    def _filter_state(self, yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, lag=4):
+        """
+        Runs the filter over yy and returns the `FilterState` after the last observation.
+        """
+        P0 = self.initial_covariance(TT, RR, QQ, P0)
+        inputs = self._filter_inputs(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0)
+        state = FilterState(inputs[1:8], inputs[8], inputs[9], lag=lag)
+        state.advance(inputs[0], t0=t0)
+        return state
+
+    def _filter_state_chunked(self, yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, lag=0,
+                              chunksize=10000):
+        """
+        Runs the filter over the blocks of yy and returns the `FilterState`
+        after the last observation.
+        """
+        P0 = self.initial_covariance(TT, RR, QQ, P0)
+        ny = np.atleast_2d(ZZ).shape[0]
+        inputs = self._filter_inputs(np.zeros((0, ny)), CC, TT, RR, QQ, DD, ZZ, HH, A0, P0)
+        state = FilterState(inputs[1:8], inputs[8], inputs[9], lag=lag)
+        for y, pattern in self.chunks(yy, chunksize):
+            state.advance(y, t0=max(t0 - state.nobs, 0), pattern=pattern)
+        return state
+
+    def chunks(self, yy=None, chunksize=10000):
+        """
+        Iterates over blocks of the data.
+
+        Parameters
+        ----------
+        yy : 2d array-like or iterator, optional
+            Dataset of observables (T x nobs), e.g. a `numpy.memmap`, or an 
+            iterator of [n x nobs] blocks, which are used as they come.  The 
+            default is the observable set passed during class instantiation.
+        chunksize : int, optional
+            The number of rows in each block of an array.
+
+        Yields
+        ------
+        y : np.array (n x nobs)
+            A float64, C-contiguous block.
+        pattern : tuple
+            The missing data pattern of the block (see `filters.missing_pattern`).  
+            For arrays, the patterns are computed on the first pass and cached 
+            for the last array and chunksize used.
+        """
+        if yy is None:
+            yy = self.yy
+
+        if isinstance(yy, Iterator):
+            for y in yy:
+                y = np.ascontiguousarray(np.atleast_2d(y), dtype=float)
+                yield y, missing_pattern(y)
+            return
+
+        if not hasattr(yy, 'shape'):
+            yy = np.asarray(yy, dtype=float)
+
+        # keyed on the object passed in, as DataFrame.values is new every time
+        cached = getattr(self, '_chunk_patterns', None)
+        if cached is None or cached[0] is not yy or cached[1] != chunksize:
+            cached = (yy, chunksize, [])
+        patterns = cached[2]
+
+        if isinstance(yy, (p.DataFrame, p.Series)):
+            yy = yy.values
+        if yy.ndim < 2:
+            yy = yy[:, np.newaxis]
+
+        for k, start in enumerate(range(0, yy.shape[0], chunksize)):
+            y = np.ascontiguousarray(yy[start:start+chunksize], dtype=float)
+            if k == len(patterns):
+                patterns.append(missing_pattern(y))
+            yield y, patterns[k]
+
+        self._chunk_patterns = cached
+
+    def update(self, state, new_rows):
+        """
+        Advances the filter by new observations.
+
+        Parameters
+        ----------
+        state : FilterState
+            From `log_lik` or `kf_everything` with `return_state=True`, or 
+            a previous call to `update`.
+        new_rows : array-like
+            [n x ny] new observations, or a single ny vector.  May contain NaN.
+
+        Returns
+        -------
+        state : FilterState
+            A new state, with the log likelihood of all the observations so far.
+            The system matrices of `state` are used, so no model is solved.
+        """
+        y = np.asarray(new_rows, dtype=float)
+        if y.ndim == 1:
+            y = y[np.newaxis, :]
+
+        state = state.copy()
+        state.advance(y)
+        return state
+
+    def fixed_lag_smoother(self, state):
+        """
+        Smooths the states of the last periods given all the observations.
+
+        Parameters
+        ----------
+        state : FilterState
+
+        Returns
+        -------
+        smoothed_means : pandas.DataFrame
+            [k x ns] E[s_t|Y_T] for the last k = min(lag, nobs) periods, 
+            indexed by the position of the period in the sample.
+        """
+        k = len(state.window)
+        if k == 0:
+            return p.DataFrame(np.zeros((0, state.At.size)), columns=self.state_names)
+
+        CC, TT, RR, QQ, DD, ZZ, HH = state.system
+        A, P, _ = state.window[0]
+        y = np.array([x[2] for x in state.window])[np.newaxis]
+        Ht = np.ascontiguousarray(np.broadcast_to(HH, (k,) + HH.shape))
+
+        smoothed = conditional_smoother(y, CC, TT, RR, QQ, DD, ZZ, Ht, A, P)[0]
+        return p.DataFrame(smoothed, columns=self.state_names,
+                           index=np.arange(state.nobs - k, state.nobs))
+
+    def simulation_smoother(self, para, ndraws=1, *args, **kwargs):
+        """
+        Draws the states and the shocks from $p(s_{1:T}, \\epsilon_{1:T}|Y_{1:T}, \\theta)$.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        ndraws : int, optional
+            Number of joint draws.  The default is 1.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        P0 : 2d arry-like or string, optional
+            [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
+            associated with the invariant distribution.  The default is `unconditional.`
+            `unconditional_fast` computes the same matrix with `lyapunov_fast`.
+        seed : int, numpy.random.Generator or None, optional
+            Seed for the random number generator.
+
+        Returns
+        -------
+        results : dict with
+             `states` -- [ndraws x T x ns] array of draws of the states
+             `shocks` -- [ndraws x T x neps] array of draws of the shocks
+
+        Notes
+        -----
+        Uses the simulation smoother of Durbin and Koopman (2002).  All draws
+        share a single pass over the covariances.  Can be used with missing 
+        (NaN) observations.
+        """
+        yy = kwargs.pop('y', self.yy)
+        P0 = kwargs.pop('P0', 'unconditional')
+        rng = _rng(kwargs.pop('seed', None))
+        yy = np.asarray(p.DataFrame(yy), dtype=float)
+
+        CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
+        A0 = kwargs.pop('A0', np.zeros(CC.shape))
+        P0 = self.initial_covariance(TT, RR, QQ, P0)
+        (yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0) = self._filter_inputs(
+            yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0)
+
+        nobs, ny = yy.shape
+        ns, neps = RR.shape
+        z0 = rng.standard_normal((ndraws, ns))
+        zeps = rng.standard_normal((ndraws, nobs, neps))
+        zeta = rng.standard_normal((ndraws, nobs, ny))
+
+        states, shocks = simulation_smoother(yy, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0,
+                                             z0, zeps, zeta)
+
+        return {'states': states, 'shocks': shocks}
+
     def pred(self, para, h=20, shocks=True, append=False, *args, **kwargs):
         """
         Draws from the predictive distribution $p(Y_{t+1:t+h}|Y_{1:T}, \theta)$.
@@ -245,7 +1049,7 @@ class StateSpaceModel(object):
 
         """
         yy = kwargs.pop('y', self.yy)
-        res = self.kf_everything(para, y=yy, *args, **kwargs)
+        res = self.kf_everything(para, y=yy, output='means', *args, **kwargs)
 
         CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
 
@@ -268,6 +1072,232 @@ class StateSpaceModel(object):
             ysim = self.yy.append(ysim)
         return ysim
 
+    def pred_batch(self, draws, h=20, nsim_per_draw=1, quantiles=None, *args, **kwargs):
+        """
+        Draws from the predictive distribution $p(Y_{T+1:T+h}|Y_{1:T}, \\theta)$ for a 
+        collection of parameters.
+
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        h : int, optional
+            The horizon of the distribution.  The default is 20.
+        nsim_per_draw : int, optional
+            Number of simulations for each draw.  The default is 1.
+        quantiles : array-like or None, optional
+            If given, the quantiles of the predictive distribution mixed over
+            the draws are returned instead of simulations.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        P0 : 2d arry-like or string, optional
+            [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
+            associated with the invariant distribution.  The default is `unconditional.`
+        seed : int, numpy.random.SeedSequence, numpy.random.Generator or None, optional
+            Source of the random numbers.
+
+        Returns
+        -------
+        ysim : np.array (ndraws x nsim_per_draw x h x ny)
+            Simulations from the predictive distribution, or, if quantiles is given,
+        yq : np.array (nquantiles x h x ny)
+            Quantiles of the predictive distribution of each observable and horizon.
+            Draws for which the model has no solution are left out.
+
+        Notes
+        -----
+        Only the filter is run, to get the distribution of the states in T+1
+        given the data; unlike `pred`, the uncertainty about these states is part 
+        of the predictive distribution.  Given a draw, the predictive distribution 
+        is normal, so the quantiles are computed from the exact means and 
+        variances rather than by simulation, and take O(ndraws x h x ny) memory.
+        """
+        yy = kwargs.pop('y', self.yy)
+        P0 = kwargs.pop('P0', 'unconditional')
+        rng = _rng(kwargs.pop('seed', None))
+
+        draws = np.atleast_2d(draws)
+        ndraws = draws.shape[0]
+        pattern = self.missing_pattern(yy)
+
+        ysim = None
+        moments = None
+        for i in range(ndraws):
+            CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(draws[i], *args, **kwargs)
+
+            ny = np.atleast_2d(ZZ).shape[0]
+            if ysim is None:
+                ysim = np.nan*np.ones((ndraws, nsim_per_draw, h, ny))
+                moments = np.nan*np.ones((2, ndraws, h, ny))
+
+            if np.isnan(TT).any():
+                continue
+
+            P0i = self.initial_covariance(TT, RR, QQ, P0)
+            (yyi, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0i) = self._filter_inputs(
+                yy, CC, TT, RR, QQ, DD, ZZ, HH, np.zeros(TT.shape[0]), P0i)
+            ns, neps = RR.shape
+
+            _, At, Pt = chand_kalman(yyi, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0i,
+                                     pattern=pattern, return_state=True)
+
+            if quantiles is not None:
+                RQR = RR @ QQ @ RR.T
+                for j in range(h):
+                    moments[0, i, j] = DD + ZZ @ At
+                    moments[1, i, j] = np.sqrt(np.abs(np.diag(ZZ @ Pt @ ZZ.T + HH)))
+                    At = CC + TT @ At
+                    Pt = TT @ Pt @ TT.T + RQR
+                continue
+
+            # the first period is s_{T+1} ~ N(At, Pt), then simulate_paths takes over
+            s1 = At + rng.standard_normal((nsim_per_draw, ns)) @ _cholpsd(0.5*(Pt + Pt.T)).T
+            cH = _cholpsd(HH)
+            eps = rng.standard_normal((nsim_per_draw, h-1, neps)) @ _cholpsd(QQ).T
+            eta = rng.standard_normal((nsim_per_draw, h, ny)) @ cH.T
+
+            ysim[i, :, 0] = s1 @ ZZ.T + DD + eta[:, 0]
+            if h > 1:
+                ysim[i, :, 1:] = simulate_paths(CC, TT, RR, DD, ZZ, s1, eps,
+                                                np.ascontiguousarray(eta[:, 1:]))[0]
+
+        if quantiles is not None:
+            valid = ~np.isnan(moments[0, :, 0, 0])
+            return _mixture_quantiles(moments[0, valid], moments[1, valid], quantiles)
+
+        return ysim
+
+    def conditional_forecast(self, para, conditions, h=None, *args, **kwargs):
+        """
+        Computes the forecast of the observables conditional on the data and
+        on assumed paths for some of the observables.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        conditions : pandas.DataFrame or 2d array-like
+            [hc x ny] paths of the observables in periods T+1, ..., T+hc, NaN
+            where unconditioned.  A DataFrame may contain only some of the
+            observables, by name.
+        h : int, optional
+            The forecast horizon, at least hc.  The default is hc.
+        sd : float or array-like, optional
+            Standard deviations of the conditions, broadcast against conditions.
+            0 (the default) makes the conditions hard; positive values make
+            them soft, so the forecast trades them off against the model.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        P0 : 2d arry-like or string, optional
+            [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
+            associated with the invariant distribution.  The default is `unconditional.`
+
+        Returns
+        -------
+        ypred : pandas.DataFrame
+            [h x ny] expected paths of DD + ZZ s_t.
+
+        See Also
+        --------
+        StateSpaceModel.conditional_forecast_batch
+        """
+        yy = p.DataFrame(kwargs.get('y', self.yy))
+        ypred = self.conditional_forecast_batch(np.atleast_2d(para), conditions, h, *args, **kwargs)[0, 0]
+
+        index = [yy.index[-1] + 1 + i for i in range(ypred.shape[0])]
+        return p.DataFrame(ypred, columns=self.obs_names, index=index)
+
+    def conditional_forecast_batch(self, draws, conditions, h=None, *args, **kwargs):
+        """
+        Computes conditional forecasts for a collection of parameters and scenarios.
+
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        conditions : pandas.DataFrame, 2d or 3d array-like
+            [nscenarios x hc x ny] paths of the observables in periods T+1, ...,
+            T+hc, NaN where unconditioned.  A single [hc x ny] scenario may be
+            passed as a 2d array or a DataFrame, which may contain only some of
+            the observables, by name; other columns raise a ValueError.
+        h : int, optional
+            The forecast horizon, at least hc.  The default is hc.
+        sd : float or array-like, optional
+            Standard deviations of the conditions, broadcast against conditions.
+            0 (the default) makes the conditions hard.
+
+        Returns
+        -------
+        ypred : np.array (ndraws x nscenarios x h x ny)
+            Expected paths of DD + ZZ s_t given the data and the conditions.
+            Draws for which the model has no solution are NaN.
+
+        Notes
+        -----
+        The conditions are treated as extra observations of DD + ZZ s_t, with
+        measurement error variance sd**2, in a window of h periods after the
+        sample.  The sample is filtered once per draw, and the window is
+        started at the resulting N(A_{T+1}, P_{T+1}), so only the h periods
+        are smoothed.  Scenarios with the same conditioned entries and sd
+        share the gains and are smoothed together.
+        """
+        yy = kwargs.pop('y', self.yy)
+        P0 = kwargs.pop('P0', 'unconditional')
+        sd = kwargs.pop('sd', 0.0)
+
+        if isinstance(conditions, p.DataFrame) and self.obs_names is not None:
+            unknown = [x for x in conditions.columns if x not in self.obs_names]
+            if unknown:
+                raise ValueError('conditions on unknown observables: %s' % unknown)
+            conditions = conditions.reindex(columns=self.obs_names)
+        conditions = np.asarray(conditions, dtype=float)
+        if conditions.ndim == 2:
+            conditions = conditions[np.newaxis]
+        nscen, hc, ny = conditions.shape
+
+        h = hc if h is None else h
+        if h < hc:
+            raise ValueError('h must be at least the length of the conditions')
+
+        cond = np.full((nscen, h, ny), np.nan)
+        cond[:, :hc] = conditions
+        var = np.zeros(cond.shape)
+        var[:, :hc] = np.broadcast_to(np.asarray(sd, dtype=float), conditions.shape)**2
+        var[np.isnan(cond)] = 0.0
+
+        # scenarios with the same pattern and sd share the gains
+        groups = OrderedDict()
+        for k in range(nscen):
+            key = (np.isnan(cond[k]).tobytes(), var[k].tobytes())
+            groups.setdefault(key, []).append(k)
+
+        draws = np.atleast_2d(draws)
+        pattern = self.missing_pattern(yy)
+
+        ypred = np.full((draws.shape[0], nscen, h, ny), np.nan)
+        for i, para in enumerate(draws):
+            CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
+            if np.isnan(TT).any():
+                continue
+
+            P0i = self.initial_covariance(TT, RR, QQ, P0)
+            (yyi, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0i) = self._filter_inputs(
+                yy, CC, TT, RR, QQ, DD, ZZ, HH, np.zeros(TT.shape[0]), P0i)
+
+            _, At, Pt = chand_kalman(yyi, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0i,
+                                     pattern=pattern, return_state=True)
+
+            for scen in groups.values():
+                Ht = np.zeros((h, ny, ny))
+                Ht[:, np.arange(ny), np.arange(ny)] = var[scen[0]]
+                states = conditional_smoother(np.ascontiguousarray(cond[scen]), CC, TT, RR, QQ,
+                                              DD, ZZ, Ht, At, 0.5*(Pt + Pt.T))
+                ypred[i, scen] = states @ ZZ.T + DD
+
+        return ypred
+
     def system_matrices(self, para, *args, **kwargs):
         """
         Returns the system matrices of the state space model.
@@ -350,47 +1380,435 @@ class StateSpaceModel(object):
 
         h : int, optional
            The maximum horizon length for the impulse responses.
+        observables : bool, optional
+           Return the responses of the observables instead of the states.
+        cumulative : bool, optional
+           Return the cumulative responses.
+
+
+        Returns
+        -------
+        irf : dict of pandas.DataFrames, one per shock, of (h+1) x nvariables
+
+
+        Notes
+        -----
+        These are the responses to 1 standard deviation shocks, orthogonalized
+        by the Cholesky factor of QQ when the shocks are correlated.
+
+        See Also
+        --------
+        StateSpaceModel.impulse_response_batch
+        """
+        observables = kwargs.get('observables', False)
+        irf = self.impulse_response_batch(np.atleast_2d(para), h, *args, **kwargs)[0]
+
+        nshocks, _, nvar = irf.shape
+        shock_names = self.shock_names
+        if shock_names is None:
+            shock_names = ['shock_' + str(i) for i in range(nshocks)]
+
+        names = self.obs_names if observables else self.state_names
+        if names is None:
+            names = [('obs_' if observables else 'state_') + str(i) for i in range(nvar)]
+
+        return {shock_names[i]: p.DataFrame(irf[i], columns=names) for i in range(nshocks)}
+
+    def impulse_response_batch(self, draws, h=20, *args, **kwargs):
+        """
+        Computes impulse response functions for a collection of parameters.
+
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        h : int, optional
+           The maximum horizon length for the impulse responses.
+        observables : bool, optional
+           Return the responses of the observables (ZZ s_t) instead of the states.
+        cumulative : bool, optional
+           Return the cumulative responses, sum_{k<=j} TT^k RR chol(QQ).
+        long_run : bool, optional
+           Return only the long run cumulative responses, (I - TT)^{-1} RR chol(QQ).
+           They are NaN for draws where I - TT is singular.
+
+        Returns
+        -------
+        irf : np.array (ndraws x nshocks x (h+1) x nvariables)
+            The responses to 1 standard deviation shocks; (ndraws x nshocks x nvariables)
+            if long_run is True.  Draws for which the model has no solution
+            are NaN.
+
+        Notes
+        -----
+        The responses of all shocks and draws are computed together, as
+        stacked matrix products TT (TT^{j} RR chol(QQ)).
+        """
+        observables = kwargs.pop('observables', False)
+        cumulative = kwargs.pop('cumulative', False)
+        long_run = kwargs.pop('long_run', False)
+
+        draws = np.atleast_2d(draws)
+        systems = [self.system_matrices(para, *args, **kwargs) for para in draws]
+
+        TT = np.array([np.atleast_2d(x[1]) for x in systems], dtype=float)
+        ZZ = np.array([np.atleast_2d(x[5]) for x in systems], dtype=float)
+        valid = ~np.isnan(TT).any(axis=(1, 2))
+        TT[~valid] = 0.0
+
+        # responses on impact, [ndraws x ns x nshocks]
+        X = np.array([np.atleast_2d(x[2]) @ _cholpsd(np.ascontiguousarray(np.atleast_2d(x[3]),
+                                                                          dtype=float))
+                      for x in systems])
+
+        ns = TT.shape[1]
+        if long_run:
+            # draws with a unit root have no long run response
+            IT = np.eye(ns) - TT
+            singular = np.linalg.cond(IT) > 1.0/np.finfo(float).eps
+            valid &= ~singular
+            IT[~valid] = np.eye(ns)
+            irf = np.linalg.solve(IT, X)
+            if observables:
+                irf = ZZ @ irf
+            irf = np.swapaxes(irf, 1, 2)
+        else:
+            irf = np.zeros((draws.shape[0], h+1) + X.shape[1:])
+            irf[:, 0] = X
+            for j in range(h):
+                irf[:, j+1] = TT @ irf[:, j]
+
+            if cumulative:
+                irf = np.cumsum(irf, axis=1)
+            if observables:
+                irf = ZZ[:, None] @ irf
+            irf = np.transpose(irf, (0, 3, 1, 2))
+
+        irf[~valid] = np.nan
+        return irf
 
+    def variance_decomposition(self, para, horizons=(1, 4, 8, 20, 40), *args, **kwargs):
+        """
+        Computes the forecast error variance decomposition of the model.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        horizons : array-like, optional
+            The forecast horizons, integers >= 1.  np.inf gives the decomposition
+            of the unconditional variance.
+        observables : bool, optional
+            Decompose the observables instead of the states.
 
         Returns
         -------
-        irf : pandas.Panel (nshocks x h x nvariables)
+        vd : dict of pandas.DataFrames, one per horizon, of nvariables x nshocks
+            The share of each shock in the forecast error variance.  For the
+            observables the last column is measurement error.
+
+        See Also
+        --------
+        StateSpaceModel.variance_decomposition_batch
+        """
+        observables = kwargs.get('observables', False)
+        vd = self.variance_decomposition_batch(np.atleast_2d(para), horizons, *args, **kwargs)[0]
+
+        _, nvar, ncols = vd.shape
+        nshocks = ncols - 1 if observables else ncols
+        shock_names = self.shock_names
+        if shock_names is None:
+            shock_names = ['shock_' + str(i) for i in range(nshocks)]
+        shock_names = list(shock_names) + (['measurement_error'] if observables else [])
 
+        names = self.obs_names if observables else self.state_names
+        if names is None:
+            names = [('obs_' if observables else 'state_') + str(i) for i in range(nvar)]
+
+        return {int(h) if np.isfinite(h) else h: p.DataFrame(x, index=names, columns=shock_names)
+                for h, x in zip(np.atleast_1d(horizons), vd)}
+
+    def variance_decomposition_batch(self, draws, horizons=(1, 4, 8, 20, 40), *args, **kwargs):
+        """
+        Computes the forecast error variance decomposition for a collection of parameters.
+
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        horizons : array-like, optional
+            The forecast horizons, integers >= 1.  np.inf gives the decomposition
+            of the unconditional variance.
+        observables : bool, optional
+            Decompose the observables instead of the states.
+        shares : bool, optional
+            Return shares of the total variance, rather than the variances
+            themselves.  The default is True.
+
+        Returns
+        -------
+        vd : np.array (ndraws x nhorizons x nvariables x nshocks)
+            The contribution of each shock to the h-step ahead forecast error
+            variance.  For the observables there is one more column, for
+            measurement error.  Draws for which the model has no solution
+            are NaN.
 
         Notes
         -----
-        These are of the model state variables impulse responses to
-        1 standard deviation shocks.  The method does not return IRFs in terms
-        of the model observables.
+        The finite horizons accumulate the diagonals of TT^j B_k B_k' TT^j',
+        with B = RR chol(QQ), in one pass up to the largest horizon; the
+        unconditional variances solve P_k = TT P_k TT' + B_k B_k' for each
+        shock.  Correlated shocks are orthogonalized by the Cholesky factor.
+        """
+        observables = kwargs.pop('observables', False)
+        shares = kwargs.pop('shares', True)
+
+        horizons = np.atleast_1d(np.asarray(horizons, dtype=float))
+        finite = np.isfinite(horizons)
+        if (horizons < 1).any() or (horizons[finite] % 1 != 0).any():
+            raise ValueError('horizons must be integers >= 1, or np.inf')
+        hmax = int(horizons[finite].max()) if finite.any() else 0
+
+        draws = np.atleast_2d(draws)
+        systems = [self.system_matrices(para, *args, **kwargs) for para in draws]
+
+        TT = np.array([np.atleast_2d(x[1]) for x in systems], dtype=float)
+        ZZ = np.array([np.atleast_2d(x[5]) for x in systems], dtype=float)
+        valid = ~np.isnan(TT).any(axis=(1, 2))
+        TT[~valid] = 0.0
+
+        B = np.array([np.atleast_2d(x[2]) @ _cholpsd(np.ascontiguousarray(np.atleast_2d(x[3]),
+                                                                          dtype=float))
+                      for x in systems])
+        ndraws, ns, nshocks = B.shape
+        nvar = ZZ.shape[1] if observables else ns
+
+        vd = np.zeros((ndraws, horizons.size, nvar, nshocks))
+
+        X = B.copy()
+        acc = np.zeros((ndraws, nvar, nshocks))
+        for j in range(1, hmax+1):
+            acc += (ZZ @ X if observables else X)**2
+            vd[:, horizons == j] = acc[:, None]
+            X = TT @ X
+
+        if not finite.all():
+            eye = np.eye(1)
+            for i in np.flatnonzero(valid):
+                for k in range(nshocks):
+                    # not through the model's cache, which is kept for the P0 of log_lik
+                    P = StateSpaceModel.initial_covariance(self, TT[i], B[i, :, k:k+1], eye)
+                    if observables:
+                        P = ZZ[i] @ P @ ZZ[i].T
+                    vd[i, ~finite, :, k] = np.diag(P)
+
+        if observables:
+            me = np.array([np.diag(np.atleast_2d(x[6])) for x in systems], dtype=float)
+            vd = np.concatenate([vd, np.broadcast_to(me[:, None, :, None],
+                                                     vd.shape[:-1] + (1,))], axis=-1)
+
+        if shares:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vd = vd / vd.sum(-1, keepdims=True)
+
+        vd[~valid] = np.nan
+        return vd
+
+    def moments(self, para, maxlag=4, *args, **kwargs):
+        """
+        Computes the population moments of the model.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        maxlag : int, optional
+            The largest lag of the autocovariances.
+        observables : bool, optional
+            Compute the moments of the observables instead of the states.
+
+        Returns
+        -------
+        results : dict with
+             `mean` -- pandas.Series of the unconditional means
+             `std` -- pandas.Series of the unconditional standard deviations
+             `autocovariance` -- [(maxlag+1) x nvariables x nvariables] array,
+                 with [k, i, j] = cov(x_{i,t}, x_{j,t-k})
+             `autocorrelation` -- the same, divided by std_i std_j
+
+        See Also
+        --------
+        StateSpaceModel.moments_batch
         """
+        observables = kwargs.pop('observables', False)
+        kwargs.pop('correlation', None)
+        autocov = self.moments_batch(np.atleast_2d(para), maxlag, *args,
+                                     observables=observables, **kwargs)[0]
         CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
 
-        if self.shock_names==None:
-            self.shock_names = ['shock_' + str(i) for i in range(QQ.shape[0])]
-            self.state_names = ['state_' + str(i) for i in range(TT.shape[0])]
-            self.obs_names = ['obs_' + str(i) for i in range(ZZ.shape[0])]
+        nvar = autocov.shape[1]
+        names = self.obs_names if observables else self.state_names
+        if names is None:
+            names = [('obs_' if observables else 'state_') + str(i) for i in range(nvar)]
 
+        mean = np.linalg.solve(np.eye(TT.shape[0]) - TT, np.ravel(CC))
+        if observables:
+            mean = np.ravel(DD) + np.atleast_2d(ZZ) @ mean
 
-        neps = QQ.shape[0]
+        std = np.sqrt(np.diag(autocov[0]))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            autocorr = autocov / np.outer(std, std)
 
-        irfs = {}
-        for i in range(neps):
+        return {'mean': p.Series(mean, index=names),
+                'std': p.Series(std, index=names),
+                'autocovariance': autocov,
+                'autocorrelation': autocorr}
 
-            At = np.zeros((TT.shape[0], h+1))
-            QQz = np.zeros_like(QQ)
-            QQz[i, i] = QQ[i, i]
-            cQQz = np.sqrt(QQz)
+    def moments_batch(self, draws, maxlag=4, *args, **kwargs):
+        """
+        Computes the population autocovariances for a collection of parameters.
 
-            #cQQz = np.linalg.cholesky(QQz)
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        maxlag : int, optional
+            The largest lag of the autocovariances.
+        observables : bool, optional
+            Compute the moments of the observables instead of the states.
+        correlation : bool, optional
+            Return autocorrelations, the autocovariances divided by
+            std_i std_j, instead.  The default is False.
 
-            At[:, 0] = (RR.dot(cQQz)[:, i]).squeeze()
+        Returns
+        -------
+        autocov : np.array (ndraws x (maxlag+1) x nvariables x nvariables)
+            [:, k, i, j] = cov(x_{i,t}, x_{j,t-k}).  Draws for which the model
+            has no solution are NaN.
 
-            for j in range(h):
-                At[:, j+1] = TT.dot(At[:, j])
+        Notes
+        -----
+        The state autocovariances are TT^k P, where P = TT P TT' + RR QQ RR'
+        is the unconditional covariance; the observables' are ZZ TT^k P ZZ',
+        plus HH at lag 0.  The powers of TT are taken for all draws at once.
+        """
+        observables = kwargs.pop('observables', False)
+        correlation = kwargs.pop('correlation', False)
+
+        draws = np.atleast_2d(draws)
+        systems = [self.system_matrices(para, *args, **kwargs) for para in draws]
+
+        TT = np.array([np.atleast_2d(x[1]) for x in systems], dtype=float)
+        valid = ~np.isnan(TT).any(axis=(1, 2))
+        TT[~valid] = 0.0
+
+        P = np.zeros(TT.shape)
+        for i in np.flatnonzero(valid):
+            P[i] = self.initial_covariance(TT[i], np.atleast_2d(systems[i][2]),
+                                           np.atleast_2d(systems[i][3]))
+
+        autocov = np.zeros((draws.shape[0], maxlag+1) + TT.shape[1:])
+        autocov[:, 0] = P
+        for k in range(maxlag):
+            autocov[:, k+1] = TT @ autocov[:, k]
+
+        if observables:
+            ZZ = np.array([np.atleast_2d(x[5]) for x in systems], dtype=float)
+            HH = np.array([np.atleast_2d(x[6]) for x in systems], dtype=float)
+            autocov = ZZ[:, None] @ autocov @ np.swapaxes(ZZ, 1, 2)[:, None]
+            autocov[:, 0] += HH
+
+        if correlation:
+            std = np.sqrt(np.diagonal(autocov[:, 0], axis1=1, axis2=2))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                autocov = autocov / (std[:, None, :, None] * std[:, None, None, :])
+
+        autocov[~valid] = np.nan
+        return autocov
+
+    def spectrum(self, para, freqs=None, *args, **kwargs):
+        """
+        Computes the spectral density of the observables.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        freqs : array-like, optional
+            Frequencies in [0, pi].  The default is 100 points from 0 to pi.
+
+        Returns
+        -------
+        spec : np.array (nfreq x ny x ny), complex
+            The spectral density matrices.  The diagonals are real.
+
+        See Also
+        --------
+        StateSpaceModel.spectrum_batch
+        """
+        return self.spectrum_batch(np.atleast_2d(para), freqs, *args, **kwargs)[0]
+
+    def spectrum_batch(self, draws, freqs=None, *args, **kwargs):
+        """
+        Computes the spectral density of the observables for a collection of parameters.
+
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        freqs : array-like, optional
+            Frequencies in [0, pi].  The default is 100 points from 0 to pi.
+
+        Returns
+        -------
+        spec : np.array (ndraws x nfreq x ny x ny), complex
+            Draws for which the model has no solution are NaN.
 
-            irfs[self.shock_names[i]] = p.DataFrame(At.T, columns=self.state_names)
+        Notes
+        -----
+        The spectral density is
+
+        .. math::
+
+        f(\\omega) = \\frac{1}{2\\pi}\\left[Z G(\\omega) R Q R' G(\\omega)^* Z' + H\\right],
+        \\quad G(\\omega) = (I - T e^{-i\\omega})^{-1}.
+
+        T = U S U^* is factored once per draw (complex Schur), so every
+        frequency costs a triangular solve, run on the whole grid together.
+        """
+        if freqs is None:
+            freqs = np.linspace(0, np.pi, 100)
+        z = np.exp(-1j*np.atleast_1d(np.asarray(freqs, dtype=float)))
+
+        draws = np.atleast_2d(draws)
+
+        spec = None
+        for i, para in enumerate(draws):
+            CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
+            ZZ, HH = np.atleast_2d(ZZ), np.atleast_2d(HH)
+            if spec is None:
+                ny = ZZ.shape[0]
+                spec = np.full((draws.shape[0], z.size, ny, ny), np.nan, dtype=complex)
 
-        return irfs
+            if np.isnan(TT).any():
+                continue
+
+            spec[i] = self._spectral_density(TT, RR, QQ, ZZ, HH, z) / (2*np.pi)
+
+        return spec
+
+    @staticmethod
+    def _spectral_density(TT, RR, QQ, ZZ, HH, z):
+        """
+        Returns ZZ G RR QQ RR' G^* ZZ' + HH, G = (I - TT z)^{-1}, for each z,
+        which is 2 pi times the spectral density at z = exp(-i omega).
+        """
+        ZZ, HH = np.atleast_2d(ZZ), np.atleast_2d(HH)
+        S, U = schur(np.atleast_2d(TT), output='complex')
+        B = U.conj().T @ np.atleast_2d(RR) @ _cholpsd(np.ascontiguousarray(np.atleast_2d(QQ),
+                                                                          dtype=float))
+        W = (ZZ @ U) @ triangular_resolvent(S, np.ascontiguousarray(B), z)
+        return W @ np.swapaxes(W.conj(), 1, 2) + HH
 
     def simulate(self, para, nsim=200, *args, **kwargs):
         """
@@ -403,33 +1821,55 @@ class StateSpaceModel(object):
 
         nsim : int, optional
             The length of the simulation. The default value is 200.
+        npaths : int or None, optional
+            Number of paths to simulate.  If None (default), a single path is
+            returned as a 2d array.
+        burn : int, optional
+            Number of initial periods to discard.  The default is nsim.
+        seed : int, numpy.random.SeedSequence, numpy.random.Generator or None, optional
+            Source of the random numbers; independent streams for parallel 
+            workers can be obtained with `SeedSequence.spawn`.
+        states : bool, optional
+            Also return the simulated states.  The default is False.
 
         Returns
         -------
-        ysim : np.array (nsim x nobs)
+        ysim : np.array (nsim x nobs), or (npaths x nsim x nobs)
+        ssim : np.array (nsim x ns), or (npaths x nsim x ns), if states is True
 
 
         Notes
         -----
         The simulation is initialized from the steady-state mean and subsequently
-        a simulation of length 2*nsim is created, with the final nsim observations
-        return.
+        a simulation of length burn+nsim is created, with the final nsim observations
+        return.  All shocks are drawn at once, using Cholesky factors of QQ and HH,
+        and the paths are simulated together by `filters.simulate_paths`.
         """
+        npaths = kwargs.pop('npaths', None)
+        burn = kwargs.pop('burn', nsim)
+        rng = _rng(kwargs.pop('seed', None))
+        states = kwargs.pop('states', False)
 
         CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
-        ysim  = np.zeros((nsim*2, DD.size))
-        At = np.zeros((TT.shape[0],))
+        CC, DD = [np.ascontiguousarray(np.ravel(x), dtype=float) for x in (CC, DD)]
+        TT, RR, QQ, ZZ, HH = [np.ascontiguousarray(np.atleast_2d(x), dtype=float)
+                              for x in (TT, RR, QQ, ZZ, HH)]
 
-        for i in range(nsim*2):
-            e = np.random.multivariate_normal(np.zeros((QQ.shape[0])), QQ)
-            At = CC + TT.dot(At) + RR.dot(e)
+        M = 1 if npaths is None else npaths
+        ns, neps = RR.shape
+        ny = ZZ.shape[0]
 
-            h = np.random.multivariate_normal(np.zeros((HH.shape[0])), HH)
-            At = np.asarray(At).squeeze()
-            ysim[i, :] = DD.T + ZZ.dot(At) + np.atleast_2d(h)
+        eps = rng.standard_normal((M, burn+nsim, neps)) @ _cholpsd(QQ).T
+        eta = rng.standard_normal((M, burn+nsim, ny)) @ _cholpsd(HH).T
+
+        ysim, ssim = simulate_paths(CC, TT, RR, DD, ZZ, np.zeros((M, ns)),
+                                    eps, eta, burn, states)
 
-        return ysim[nsim:, :]
+        if npaths is None:
+            ysim = ysim[0]
+            ssim = ssim[0] if states else ssim
 
+        return (ysim, ssim) if states else ysim
 
     def forecast(self, para, h=20, shocks=True, *args, **kwargs):
         t0 = kwargs.pop('t0', self.t0)
@@ -437,9 +1877,7 @@ class StateSpaceModel(object):
         P0 = kwargs.pop('P0', 'unconditional')
 
         CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
-
-        if P0=='unconditional':
-            P0 = solve_discrete_lyapunov(TT, RR.dot(QQ).dot(RR.T))
+        P0 = self.initial_covariance(TT, RR, QQ, P0)
 
         data = np.asarray(yy)
         nobs, ny = yy.shape
@@ -504,7 +1942,118 @@ class StateSpaceModel(object):
         return results
 
     def historical_decomposition(self, para, *args, **kwargs):
-        pass
+        """
+        Decomposes the smoothed states, or the observables, into the
+        contributions of each shock and of the initial conditions.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        observables : bool, optional
+            Decompose the observables instead of the states.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        P0 : 2d arry-like or string, optional
+            [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
+            associated with the invariant distribution.  The default is `unconditional.`
+
+        Returns
+        -------
+        hd : dict of pandas.DataFrames, T x nvariables, with one entry per shock,
+            `initial` for the initial conditions and constants and, for the
+            observables, `measurement_error`.  The entries sum to the smoothed
+            states, or to the data.
+
+        See Also
+        --------
+        StateSpaceModel.historical_decomposition_batch
+        """
+        observables = kwargs.get('observables', False)
+        yy = p.DataFrame(kwargs.get('y', self.yy))
+        hd = self.historical_decomposition_batch(np.atleast_2d(para), *args, **kwargs)[0]
+
+        _, nvar, ncols = hd.shape
+        nshocks = ncols - 2 if observables else ncols - 1
+        shock_names = self.shock_names
+        if shock_names is None:
+            shock_names = ['shock_' + str(i) for i in range(nshocks)]
+        shock_names = list(shock_names) + ['initial'] + (['measurement_error'] if observables else [])
+
+        names = self.obs_names if observables else self.state_names
+        if names is None:
+            names = [('obs_' if observables else 'state_') + str(i) for i in range(nvar)]
+
+        return {name: p.DataFrame(hd[:, :, i], columns=names, index=yy.index)
+                for i, name in enumerate(shock_names)}
+
+    def historical_decomposition_batch(self, draws, *args, **kwargs):
+        """
+        Computes the historical decomposition for a collection of parameters.
+
+        Parameters
+        ----------
+        draws : 2d array-like
+            [ndraws x npara] array of parameter values, e.g. posterior draws.
+        observables : bool, optional
+            Decompose the observables instead of the states.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        P0 : 2d arry-like or string, optional
+            [ns x ns] initial covariance matrix of states, or `unconditional` to use the one
+            associated with the invariant distribution.  The default is `unconditional.`
+
+        Returns
+        -------
+        hd : np.array (ndraws x T x nvariables x (nshocks+1))
+            The contributions of the smoothed shocks, then of the initial
+            conditions and constants.  For the observables there is one more
+            column, the smoothed measurement error, which is NaN where the
+            data are missing.  Draws for which the model has no solution are NaN.
+
+        Notes
+        -----
+        The shocks are the smoothed means E[e_t|Y] from the disturbance
+        smoother; their contributions are propagated with a single linear
+        recursion per draw.
+        """
+        observables = kwargs.pop('observables', False)
+        yy = kwargs.pop('y', self.yy)
+        P0 = kwargs.pop('P0', 'unconditional')
+        yy = np.asarray(p.DataFrame(yy), dtype=float)
+
+        draws = np.atleast_2d(draws)
+        nobs, ny = yy.shape
+
+        hd = None
+        for i, para in enumerate(draws):
+            CC, TT, RR, QQ, DD, ZZ, HH = self.system_matrices(para, *args, **kwargs)
+            ns, neps = np.atleast_2d(RR).shape
+            if hd is None:
+                nvar = ny if observables else ns
+                hd = np.full((draws.shape[0], nobs, nvar, neps+1+observables), np.nan)
+
+            if np.isnan(TT).any():
+                continue
+
+            P0i = self.initial_covariance(TT, RR, QQ, P0)
+            (yyi, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0i) = self._filter_inputs(
+                yy, CC, TT, RR, QQ, DD, ZZ, HH, np.zeros(ns), P0i)
+
+            states, shocks = disturbance_smoother(yyi, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0i)
+            contrib = shock_decomposition(CC, TT, RR, states[0], shocks)
+
+            if observables:
+                hd[i, :, :, :-1] = np.einsum('ij,tjk->tik', ZZ, contrib)
+                hd[i, :, :, -2] += DD
+                hd[i, :, :, -1] = yy - DD - states @ ZZ.T
+            else:
+                hd[i] = contrib
+
+        return hd
+
 
 
 class LinearDSGEModel(StateSpaceModel):
@@ -512,7 +2061,7 @@ class LinearDSGEModel(StateSpaceModel):
     def __init__(self, yy, GAM0, GAM1, PSI, PPI,
                  QQ, DD, ZZ, HH, t0=0,
                  shock_names=None, state_names=None, obs_names=None,
-                 prior=None):
+                 prior=None, derivatives=None):
 
         if len(yy.shape) < 2:
             yy = np.swapaxes(np.atleast_2d(yy), 0, 1)
@@ -536,6 +2085,14 @@ class LinearDSGEModel(StateSpaceModel):
 
         self.prior = prior
 
+        # callable returning the functions computing the derivatives of the
+        # matrices above (see DSGE.python_sims_derivatives); built on first use.
+        self.derivatives = derivatives
+        self._derivative_functions = None
+
+        # see enable_cache
+        self._cache = None
+
     def solve_LRE(self, para, *args, **kwargs):
 
         G0 = self.GAM0(para, *args, **kwargs)
@@ -563,7 +2120,81 @@ class LinearDSGEModel(StateSpaceModel):
 
         return TT, RR, RC
 
+    def enable_cache(self, maxsize=128):
+        """
+        Caches the system matrices, and the unconditional covariance of the 
+        states derived from them, for the last `maxsize` parameter vectors.
+
+        Calls to `system_matrices` with the same `para` (and no other 
+        arguments) then skip solving the model, e.g. when `impulse_response`,
+        `simulate` and `kf_everything` are called on the same draw.  Cached
+        matrices are returned as copies.
+
+        See Also
+        --------
+        LinearDSGEModel.cache_info, LinearDSGEModel.clear_cache
+        """
+        self._cache = {'maxsize': maxsize,
+                       'system_matrices': {'hits': 0, 'misses': 0, 'data': OrderedDict()},
+                       'P0': {'hits': 0, 'misses': 0, 'data': OrderedDict()}}
+
+    def disable_cache(self):
+        """Disables and empties the cache."""
+        self._cache = None
+
+    def clear_cache(self):
+        """Empties the cache and resets its counters, e.g. after changing the model functions."""
+        if self._cache is not None:
+            self.enable_cache(self._cache['maxsize'])
+
+    def cache_info(self):
+        """
+        Returns the `hits`, `misses` and `currsize` of the `system_matrices` and
+        `P0` caches and their `maxsize`, or None if the cache is not enabled.
+        """
+        if self._cache is None:
+            return None
+
+        info = {'maxsize': self._cache['maxsize']}
+        for name in ['system_matrices', 'P0']:
+            cache = self._cache[name]
+            info[name] = {'hits': cache['hits'], 'misses': cache['misses'],
+                          'currsize': len(cache['data'])}
+        return info
+
+    def _cached(self, name, key, func):
+        """Looks up key in the LRU cache `name`, calling func on a miss."""
+        cache = self._cache[name]
+        data = cache['data']
+        if key in data:
+            data.move_to_end(key)
+            cache['hits'] += 1
+        else:
+            cache['misses'] += 1
+            data[key] = func()
+            if len(data) > self._cache['maxsize']:
+                data.popitem(last=False)
+        return tuple(np.copy(x) for x in data[key])
+
+    def initial_covariance(self, TT, RR, QQ, P0='unconditional', factor=False):
+        if self._cache is None or not isinstance(P0, str):
+            return super().initial_covariance(TT, RR, QQ, P0, factor=factor)
+
+        TT, RR, QQ = [np.ascontiguousarray(x, dtype=float) for x in (TT, RR, QQ)]
+        key = (P0, factor, TT.tobytes(), RR.tobytes(), QQ.tobytes())
+        func = lambda: (super(LinearDSGEModel, self).initial_covariance(TT, RR, QQ, P0, factor=factor),)
+        return self._cached('P0', key, func)[0]
+
+    initial_covariance.__doc__ = StateSpaceModel.initial_covariance.__doc__
+
     def system_matrices(self, para, *args, **kwargs):
+        if self._cache is None or args or kwargs:
+            return self._system_matrices(para, *args, **kwargs)
+
+        key = np.asarray(para, dtype=float).tobytes()
+        return self._cached('system_matrices', key, lambda: self._system_matrices(para))
+
+    def _system_matrices(self, para, *args, **kwargs):
 
         TT, RR, RC = self.solve_LRE(para, *args, **kwargs)
         CC = np.zeros(TT.shape[0])
@@ -578,6 +2209,131 @@ class LinearDSGEModel(StateSpaceModel):
 
         return CC, TT, RR, QQ, DD, ZZ, HH
 
+    def system_matrices_derivatives(self, para, *args, **kwargs):
+        """
+        Returns the system matrices and their derivatives with respect to para.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+
+        Returns
+        -------
+        mats : tuple
+            CC, TT, RR, QQ, DD, ZZ, HH, as in `system_matrices`, except
+            that TT is restricted to the stable subspace of the solution.
+        dmats : tuple
+            The derivatives dCC, dTT, dRR, dQQ, dDD, dZZ, dHH, each
+            with a leading dimension of length npara.
+        """
+        if self.derivatives is None:
+            raise ValueError('No derivatives of the system matrices available.')
+
+        if self._derivative_functions is None:
+            self._derivative_functions = self.derivatives()
+        dfuncs = self._derivative_functions
+
+        G0 = np.atleast_2d(self.GAM0(para, *args, **kwargs))
+        G1 = np.atleast_2d(self.GAM1(para, *args, **kwargs))
+        PSI = np.atleast_2d(self.PSI(para, *args, **kwargs))
+        PPI = np.atleast_2d(self.PPI(para, *args, **kwargs))
+
+        dG0, dG1, dPSI, dPPI = [dfuncs[name](para) for name in ['GAM0', 'GAM1', 'PSI', 'PPI']]
+        npara = dG0.shape[0]
+
+        if PPI.shape[1] > 0:
+            TT, RR, dTT, dRR, RC = gensys_derivative(G0, G1, PSI, PPI,
+                                                     dG0, dG1, dPSI, dPPI)
+        else:
+            iG0 = np.linalg.inv(G0)
+            TT = iG0.dot(G1)
+            RR = iG0.dot(PSI)
+            dTT = np.einsum('ij,pjk->pik', iG0, dG1 - np.einsum('pij,jk->pik', dG0, TT))
+            dRR = np.einsum('ij,pjk->pik', iG0, dPSI - np.einsum('pij,jk->pik', dG0, RR))
+
+        ns = TT.shape[0]
+        CC = np.zeros(ns)
+        QQ = np.atleast_2d(self.QQ(para, *args, **kwargs))
+        DD = np.atleast_1d(self.DD(para, *args, **kwargs))
+        ZZ = np.atleast_2d(self.ZZ(para, *args, **kwargs))
+        HH = np.atleast_1d(self.HH(para, *args, **kwargs))
+
+        ny = ZZ.shape[0]
+        dCC = np.zeros((npara, ns))
+        dQQ = dfuncs['QQ'](para)
+        dDD = dfuncs['DD'](para).reshape(npara, ny)
+        dZZ = dfuncs['ZZ'](para)
+        dHH = dfuncs['HH'](para).reshape(npara, ny, ny)
+
+        return (CC, TT, RR, QQ, DD, ZZ, HH), (dCC, dTT, dRR, dQQ, dDD, dZZ, dHH)
+
+    def log_lik_grad(self, para, *args, **kwargs):
+        """
+        Computes the gradient of the log likelihood.
+
+        The derivatives of the system matrices are propagated through
+        the solution of the model and a differentiated Kalman filter in
+        a single forward pass.
+
+        Parameters
+        ----------
+        para : array-like
+            An npara length vector of parameter values that defines the system matrices.
+        t0 : int, optional
+            Number of initial observations to condition on.
+        y : 2d array-like, optional
+            Dataset of observables (T x nobs). The default is the observable set pass during
+            class instantiation.
+        return_lik : bool, optional
+            Also return the log likelihood (default = False).
+
+        Returns
+        -------
+        grad : np.array (npara)
+            The gradient of the log likelihood.
+        lik : float
+            The log likelihood, if return_lik is True.
+
+        Notes
+        -----
+        The initial state is drawn from the invariant distribution of the
+        model, whose covariance is differentiated as well.
+        """
+        t0 = kwargs.pop('t0', self.t0)
+        yy = kwargs.pop('y', self.yy)
+        return_lik = kwargs.pop('return_lik', False)
+
+        mats, dmats = self.system_matrices_derivatives(para, *args, **kwargs)
+        CC, TT, RR, QQ, DD, ZZ, HH = mats
+        dCC, dTT, dRR, dQQ, dDD, dZZ, dHH = dmats
+        npara, ns = dCC.shape
+        ny = ZZ.shape[0]
+
+        if (np.isnan(TT)).any():
+            grad = np.nan*np.ones(npara)
+            return (-1000000000000.0, grad) if return_lik else grad
+
+        RQR = RR.dot(QQ).dot(RR.T)
+        P0 = solve_discrete_lyapunov(TT, RQR)
+        dP0 = np.zeros((npara, ns, ns))
+        for j in range(npara):
+            x = dTT[j].dot(P0).dot(TT.T) + RR.dot(QQ).dot(dRR[j].T)
+            dP0[j] = solve_discrete_lyapunov(TT, x + x.T + RR.dot(dQQ[j]).dot(RR.T))
+
+        lik, grad = kalman_filter_grad(np.ascontiguousarray(yy, dtype=float),
+                                       CC, TT, RR, QQ,
+                                       np.asarray(DD, dtype=float).reshape(ny),
+                                       np.asarray(ZZ, dtype=float),
+                                       np.asarray(HH, dtype=float).reshape(ny, ny),
+                                       np.zeros(ns), P0,
+                                       dCC, dTT, dRR, dQQ, dDD, dZZ, dHH,
+                                       np.zeros((npara, ns)), dP0, t0=t0)
+
+        if return_lik:
+            return lik, grad
+        return grad
+
     def log_pr(self, para, *args, **kwargs):
         try:
             return self.prior.logpdf(para)
@@ -593,6 +2349,14 @@ class LinearDSGEModel(StateSpaceModel):
             x = -1000000000.
         return x
 
+    def log_post_batch(self, paras, *args, **kwargs):
+        paras = np.atleast_2d(paras)
+        x = self.log_lik_batch(paras, **kwargs)
+        x = x + np.array([self.log_pr(para) for para in paras], dtype=float)
+        x[np.isnan(x)] = -1000000000.
+        x[x < -1000000000.] = -1000000000.
+        return x
+
 
 
 if __name__ == '__main__':
@@ -610,36 +2374,3 @@ if __name__ == '__main__':
     test_ss = StateSpaceModel(yy, TT, RR, QQ, DD, ZZ, HH)
     print( test_ss.system_matrices(0.3))
     print( test_ss.log_lik(0.3))
-    # if reduce_system:
-    #     f = filter.filter.kalman_filter_missing_with_states
-    #     loglh, filtered_states, smoothed_states = f(yy.T, TT, RR, QQ, DD, ZZ, HH, t0)
-
-    #     from scipy.linalg import schur
-    #     (Z, T, nmin) = schur(TT, sort=lambda x: abs(x**2)>1e-15)
-
-    #     RRhat = Z.T.dot(RR)
-    #     ishock = np.argwhere(abs(RRhat[nmin:, :]).sum(0)>1e-10).flatten()
-    #     neshock = ishock.size
-
-    #     if neshock>0:
-    #         TThat = np.hstack((T[:nmin,:][:, :nmin], T[:nmin, :][:, nmin:].dot(RRhat[nmin:, :][:, ishock])))
-    #         TThat = np.vstack((TThat, np.zeros((neshock, nmin+neshock))))
-
-    #         imat = np.zeros((TT.shape[0], neshock+nmin))
-    #         imat[:nmin, :][:, :nmin] = np.eye(nmin)
-    #         imat[nmin:, :][:, nmin:] = RRhat[nmin:, :][:, ishock]
-
-    #         x = np.zeros((neshock, RR.shape[1]))
-    #         x[:, ishock] = np.eye(neshock)
-
-    #         RRhat = np.vstack((RRhat[:nmin, :], x))
-    #         ZZhat = ZZ.dot(Z).dot(imat)
-
-    #     else:
-    #         jfdsklf
-
-    #     loglh, filtered_states, smoothed_states = f(yy.T, TT, RR, QQ, DD, ZZ, HH, t0)
-
-    #     TT = TThat.copy()
-    #     RR = RRhat.copy()
-    #     ZZ = ZZhat.copy()
@@ -0,0 +1,80 @@
+"""
+Ahead-of-time compilation of the filters.
+
+    python -m dsge.aot
+
+builds the extension module `dsge._filters_aot`, containing
+`chand_recursion`, `kalman_filter` and `filter_and_smooth` compiled for
+float64, C-contiguous inputs.  When the module is present,
+`StateSpaceModel.log_lik` and `StateSpaceModel.kf_everything` use it, so
+no JIT compilation happens on the first call in a new process.
+"""
+import os
+
+from . import filters
+
+M = 'f8[:, ::1]'
+V = 'f8[::1]'
+
+# y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0
+SYSTEM = ', '.join([M, V, M, M, M, V, M, M, V, M])
+
+signatures = {
+    'chand_recursion': 'f8(%s, i8, f8)' % SYSTEM,
+    'kalman_filter': 'f8(%s, i8, f8)' % SYSTEM,
+    'filter_and_smooth': ('Tuple((f8[:], f8[:, :], f8[:, :], f8[:, :, :], '
+                          'f8[:, :], f8[:, :], f8[:, :, :], '
+                          'f8[:, :], f8[:, :], f8[:, :, :]))(%s, i8, i8)' % SYSTEM),
+}
+
+
+def build(output_dir=None, verbose=False):
+    """
+    Compiles the extension module `_filters_aot`.
+
+    Parameters
+    ----------
+    output_dir : str, optional
+        Where to put the module.  The default is the `dsge` package directory.
+    """
+    from numba.pycc import CC
+
+    cc = CC('_filters_aot')
+    cc.output_dir = output_dir or os.path.dirname(os.path.abspath(__file__))
+    cc.verbose = verbose
+
+    for name, sig in signatures.items():
+        cc.export(name, sig)(getattr(filters, name).py_func)
+
+    cc.compile()
+
+
+def load():
+    """
+    Returns the ahead-of-time compiled filters, keyed like `filt_choices`,
+    or an empty dict if `_filters_aot` has not been built.
+
+    The compiled functions only accept float64, C-contiguous arrays with
+    CC, DD and A0 one dimensional.
+    """
+    try:
+        from . import _filters_aot
+    except ImportError:
+        return {}
+
+    def chand_recursion(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, ss_tol=0.0):
+        return _filters_aot.chand_recursion(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0, ss_tol)
+
+    def kalman_filter(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, ss_tol=0.0):
+        return _filters_aot.kalman_filter(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0, ss_tol)
+
+    def filter_and_smooth(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, output=1):
+        return _filters_aot.filter_and_smooth(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0, output)
+
+    return {'chand_recursion': chand_recursion,
+            'kalman_filter': kalman_filter,
+            'filter_and_smooth': filter_and_smooth}
+
+
+if __name__ == '__main__':
+    build(verbose=True)
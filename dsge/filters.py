@@ -1,10 +1,12 @@
 import numpy as np
 
-from numba import jit
+from scipy.linalg import solve_triangular
 
+from numba import jit, prange, get_num_threads
 
-@jit(nopython=True)
-def chand_recursion(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
+
+@jit(nopython=True, cache=True)
+def chand_recursion(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, ss_tol=0.0):
     nobs, ny = y.shape
     ns = TT.shape[0]
 
@@ -22,18 +24,29 @@ def chand_recursion(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
     Mt = -iFt
     Kt = St @ iFt
 
+    # once the gain has converged (ss_tol > 0), Kt, Ft, log det Ft
+    # and inv(Ft) are frozen and only the mean recursion is run.
+    converged = False
+    dFt = 0.0
+
     for i in range(nobs):
         yhat = ZZ @ At + DD.flatten()
         nut = y[i] - yhat
 
-        dFt = np.log(np.linalg.det(Ft))
-        iFtnut = np.linalg.solve(Ft, nut)
+        if converged:
+            iFtnut = iFt @ nut
+        else:
+            dFt = np.log(np.linalg.det(Ft))
+            iFtnut = np.linalg.solve(Ft, nut)
 
         if i >= t0:
             loglh = loglh - 0.5*ny*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(nut, iFtnut)
 
         At = CC + TT@At + Kt @ nut.T
-        
+
+        if converged:
+            continue
+
         ZZSt = ZZ@St;
         MSpZp = Mt@(ZZSt.T);
         TTSt = TT@St;
@@ -42,18 +55,24 @@ def chand_recursion(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
         Ft1  = 0.5*(Ft1+Ft1.T);           
         iFt1 = np.linalg.inv(Ft1);
         
-        Kt = (Kt@Ft + TTSt@MSpZp)@iFt1; # K_{t+1}
-        St = TTSt - Kt@ZZSt;            # S_{t+1}
+        Kt1 = (Kt@Ft + TTSt@MSpZp)@iFt1; # K_{t+1}
+        St = TTSt - Kt1@ZZSt;            # S_{t+1}
         Mt = Mt + MSpZp@iFt@MSpZp.T;     # M_{t+1}
         Mt = 0.5*(Mt + Mt.T);
         Ft = Ft1;
         iFt = iFt1;
 
+        if ss_tol > 0.0 and np.max(np.abs(Kt1 - Kt)) < ss_tol:
+            converged = True
+            dFt = np.log(np.linalg.det(Ft))
+
+        Kt = Kt1;
+
     return loglh
 
 
-@jit(nopython=True)
-def kalman_filter(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
+@jit(nopython=True, cache=True)
+def kalman_filter(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, ss_tol=0.0):
 
     #y = np.asarray(y)
     nobs, ny = y.shape
@@ -65,10 +84,33 @@ def kalman_filter(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
 
     loglh = 0.0
     AA = np.zeros(shape=(ns))
+
+    # steady state quantities, used once the gain has converged (ss_tol > 0);
+    # a period with missing observations resumes the covariance recursion.
+    converged = False
+    dFt = 0.0
+    iFt = np.zeros((ny, ny))
+    Kt = np.zeros((ns, ny))
+    iFtKt_old = np.zeros((ny, ns))
+
     for i in range(nobs):
 
         not_missing = ~np.isnan(y[i])
         nact = not_missing.sum()
+
+        if converged and nact < ny:
+            converged = False
+
+        if converged:
+            nut = y[i] - ZZ @ AA - DD.flatten()
+            iFtnut = iFt @ nut
+
+            if i >= t0:
+                loglh = loglh - 0.5*ny*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(nut, iFtnut)
+
+            AA = CC + TT @ AA + Kt @ iFtnut
+            continue
+
         yhat = ZZ[not_missing,:] @ AA + DD.flatten()[not_missing]
 
         nut = y[i][not_missing] - yhat
@@ -86,73 +128,117 @@ def kalman_filter(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
         Kt = TTPt @ ZZ[not_missing,:].T
 
         AA = CC + TT @ AA + Kt @ iFtnut
-        Pt = TTPt @ TT.T - Kt @ np.linalg.solve(Ft, Kt.T) + RQR
+        iFtKt = np.linalg.solve(Ft, Kt.T)
+        Pt = TTPt @ TT.T - Kt @ iFtKt + RQR
+
+        if ss_tol > 0.0 and nact == ny:
+            if np.max(np.abs(iFtKt - iFtKt_old)) < ss_tol:
+                converged = True
+                iFt = np.linalg.inv(Ft)
+            iFtKt_old = iFtKt
 
     return loglh
 
 
 
-@jit(nopython=True)
-def filter_and_smooth(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0,t0=0):
+@jit(nopython=True, cache=True)
+def filter_and_smooth(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, output=1):
+    """
+    Kalman filter and smoother.
+
+    Parameters
+    ----------
+    output : int, optional
+        What is stored and returned:
+        0 -- means only,
+        1 -- means and stds (default),
+        2 -- means, stds and the full covariance matrices.
+        Arrays that are not requested are returned with a zero length
+        first dimension.
 
+    Notes
+    -----
+    The smoothed means are computed with the fast state smoother of
+    Durbin and Koopman (2012), which only requires the gains.  For the
+    smoothed stds, the forecast covariances are kept every sqrt(nobs)
+    periods and recomputed one block at a time in the backward pass, so
+    the [nobs x ns x ns] covariances are only stored when requested.
+    """
     nobs, ny = y.shape
     ns = TT.shape[0]
 
-    At = A0
-    Pt = P0
+    At = A0.copy()
+    Pt = P0.copy()
     RQR = np.dot(np.dot(RR, QQ), RR.T)
+    DD = DD.flatten()
 
-    loglh = 0.0
+    nstd = nobs if output > 0 else 0
+    ncov = nobs if output > 1 else 0
+
+    # checkpoints of the forecast covariance, for the smoothed stds
+    stride = max(int(np.sqrt(nobs)), 1)
+    nchk = (nobs + stride - 1) // stride if output == 1 else 0
+    checkpoints = np.zeros((nchk, ns, ns))
+    block = np.zeros((stride if output == 1 else 0, ns, ns))
+    block_id = -1
 
     forecast_means = np.zeros((nobs, ns))
-    forecast_stds = np.zeros((nobs, ns))
-    forecast_cov = np.zeros((nobs, ns, ns))
+    forecast_stds = np.zeros((nstd, ns))
+    forecast_cov = np.zeros((ncov, ns, ns))
 
     filtered_means = np.zeros((nobs, ns))
-    filtered_stds = np.zeros((nobs, ns))
-    filtered_cov = np.zeros((nobs, ns, ns))
+    filtered_stds = np.zeros((nstd, ns))
+    filtered_cov = np.zeros((ncov, ns, ns))
 
     smoothed_means = np.zeros((nobs, ns))
-    smoothed_stds = np.zeros((nobs, ns))
-    smoothed_cov = np.zeros((nobs, ns, ns))
+    smoothed_stds = np.zeros((nstd, ns))
+    smoothed_cov = np.zeros((ncov, ns, ns))
 
     liks = np.zeros(nobs)
 
-    Lmat = np.zeros((nobs,ns,ns))
+    # quantities needed by the smoother, padded to ny observables
+    observed = ~np.isnan(y)
+    PZiF = np.zeros((nobs, ns, ny))
+    iFt_all = np.zeros((nstd, ny, ny))
     ZtiFtnut = np.zeros((nobs, ns))
-    ZtiFtZ = np.zeros((nobs, ns, ns))
 
     for i in range(nobs):
 
-        observed = ~np.isnan(y[i])
-        nact = np.sum(observed)
+        nact = np.sum(observed[i])
 
         forecast_means[i] = At
-        forecast_stds[i] = np.sqrt(np.diag(Pt))
-        forecast_cov[i] = 0.5*(Pt + Pt.T)
+        if output > 0:
+            forecast_stds[i] = np.sqrt(np.abs(np.diag(Pt)))
+        if output > 1:
+            forecast_cov[i] = 0.5*(Pt + Pt.T)
+        elif output == 1 and i % stride == 0:
+            checkpoints[i // stride] = Pt
 
         if nact > 0:
 
-            yhat = (ZZ @ At)[observed] + DD[observed].flatten()
-            nut = y[i][observed] - yhat 
+            ZZo = ZZ[observed[i], :]
+            yhat = ZZo @ At + DD[observed[i]]
+            nut = y[i][observed[i]] - yhat
 
-            Ft = (ZZ @ Pt @ ZZ.T + HH)[observed, :][:, observed]
+            PZ = Pt @ ZZo.T
+            Ft = ZZo @ PZ + HH[observed[i], :][:, observed[i]]
             Ft = 0.5 * (Ft + Ft.T)
 
-            dFt = np.log(np.linalg.det(Ft))
-            iFtnut = np.linalg.solve(Ft, nut)
+            iFt = np.linalg.inv(Ft)
+            iFtnut = iFt @ nut
 
             if i >= t0:
+                dFt = np.log(np.linalg.det(Ft))
                 liks[i] = - 0.5*nact*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(nut, iFtnut)
 
-            Kt = Pt @ ZZ[observed, :].T
+            Kt = PZ @ iFt
+            PZiF[i][:, :nact] = Kt
+            if output > 0:
+                iFt_all[i][:nact, :nact] = iFt
+            ZtiFtnut[i] = ZZo.T @ iFtnut
 
-            Lmat[i] = TT - TT @ Pt @ ZZ[observed,:].T @ np.linalg.inv(Ft) @ ZZ[observed,:]
-            ZtiFtnut[i] = ZZ[observed,:].T @ iFtnut
-            ZtiFtZ[i] = ZZ[observed,:].T @ np.linalg.inv(Ft) @ ZZ[observed,:]
-
-            At1 = At + Kt @ iFtnut
-            Pt1 = Pt - Kt @ np.linalg.solve(Ft, Kt.T)
+            At1 = At + Kt @ nut
+            Pt1 = Pt - Kt @ PZ.T
 
         else:
 
@@ -160,30 +246,1150 @@ def filter_and_smooth(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0,t0=0):
             Pt1 = Pt
 
         filtered_means[i] = At1
-        filtered_stds[i] = np.sqrt(np.diag(Pt1))
-        filtered_cov[i] = 0.5*(Pt1 + Pt1.T)
+        if output > 0:
+            filtered_stds[i] = np.sqrt(np.abs(np.diag(Pt1)))
+        if output > 1:
+            filtered_cov[i] = 0.5*(Pt1 + Pt1.T)
 
         # forecast 
         At = CC + TT @ At1
         Pt = TT @ Pt1 @ TT.T + RQR
 
 
-    # smoother
-    smoothed_means[-1] = filtered_means[-1]
-    smoothed_stds[-1] = filtered_stds[-1]
-    smoothed_cov[-1] = filtered_cov[-1]
-   
-    r = np.zeros((nobs+1, ns))
-    N = np.zeros((ns,ns))
+    # smoother: r_{t-1} = Z'F^{-1}v_t + L_t'r_t, N_{t-1} = Z'F^{-1}Z + L_t'N_tL_t
+    # with L_t = TT(I - P_t Z'F^{-1} Z)
+    r = np.zeros(ns)
+    N = np.zeros((ns, ns))
+    rprev = np.zeros((nobs, ns))
+
+    for i in range(nobs-1, -1, -1):
+        nact = np.sum(observed[i])
+        ZZo = ZZ[observed[i], :]
+        Kt = PZiF[i][:, :nact]
+
+        TTr = TT.T @ r
+        r = ZtiFtnut[i] + TTr - ZZo.T @ (Kt.T @ TTr)
+        rprev[i] = r
+
+        if output > 0:
+            Lt = TT - (TT @ Kt) @ ZZo
+            iFt = iFt_all[i][:nact, :nact]
+            N = ZZo.T @ iFt @ ZZo + Lt.T @ N @ Lt
+            N = 0.5*(N + N.T)
+
+            if output > 1:
+                Pf = forecast_cov[i]
+            else:
+                b = i // stride
+                if b != block_id:
+                    # redo the covariance recursion over the block
+                    P = checkpoints[b].copy()
+                    for k in range(b*stride, min((b+1)*stride, nobs)):
+                        block[k - b*stride] = 0.5*(P + P.T)
+                        nk = np.sum(observed[k])
+                        if nk > 0:
+                            PZ = P @ ZZ[observed[k], :].T
+                            P = P - PZiF[k][:, :nk] @ PZ.T
+                        P = TT @ P @ TT.T + RQR
+                    block_id = b
+                Pf = block[i - b*stride]
 
-    for i in range(nobs-2,-1,-1):
-        r[i-1] = ZtiFtnut[i] + Lmat[i].T @ r[i]
-        smoothed_means[i] = forecast_means[i] + forecast_cov[i] @ r[i-1] 
+            Vt = Pf - Pf @ N @ Pf
+            smoothed_stds[i] = np.sqrt(np.abs(np.diag(Vt)))
+            if output > 1:
+                smoothed_cov[i] = 0.5*(Vt + Vt.T)
 
-        N = ZtiFtZ[i] + Lmat[i].T @ N @ Lmat[i]
-        smoothed_cov[i] = forecast_cov[i] - forecast_cov[i] @ N @ forecast_cov[i].T
-        smoothed_stds[i] = np.sqrt(np.diag(smoothed_cov[i]))
+    smoothed_means[0] = A0 + P0 @ rprev[0]
+    for i in range(1, nobs):
+        smoothed_means[i] = CC + TT @ smoothed_means[i-1] + RQR @ rprev[i]
 
     return (liks, filtered_means, filtered_stds, filtered_cov,
             forecast_means, forecast_stds, forecast_cov,
             smoothed_means, smoothed_stds, smoothed_cov)
+
+
+@jit(nopython=True, cache=True)
+def _cholpsd(x):
+    """Lower triangular factor of a positive semi-definite matrix.
+
+    Directions with zero variance get a zero column, so singular
+    covariance matrices (e.g. no measurement error) are allowed.
+    """
+    n = x.shape[0]
+    y = np.tril(0.5*(x + x.T))
+    for k in range(n):
+        if y[k, k] > 1e-14:
+            y[k, k] = np.sqrt(y[k, k])
+            y[k+1:, k] = y[k+1:, k]/y[k, k]
+            for j in range(k+1, n):
+                y[j:, j] = y[j:, j] - y[j:, k]*y[j, k]
+        else:
+            y[k:, k] = 0.0
+    return y
+
+
+@jit(nopython=True, cache=True)
+def lyapunov_doubling(TT, RQR, P0, tol=1e-12, maxit=100):
+    """
+    Solves P = TT P TT' + RQR by doubling, starting from P0.
+
+    Writing P = P0 + X, X solves X = TT X TT' + E with E = TT P0 TT' + RQR - P0.
+    The doubling iterations X <- X + A X A', A <- A A with X = E, A = TT
+    stop once the increment is below tol relative to P, so a good starting
+    value (e.g. the solution at a nearby parameter) needs fewer steps.
+
+    Returns
+    -------
+    P : [ns x ns] solution.
+    converged : bool
+        False if the tolerance was not met in maxit steps, e.g. when TT 
+        has a unit root.
+    """
+    E = TT @ P0 @ TT.T + RQR - P0
+    X = 0.5*(E + E.T)
+    A = TT.copy()
+
+    scale = max(np.abs(P0).max(), np.abs(RQR).max())
+    for i in range(maxit):
+        dX = A @ X @ A.T
+        X = X + dX
+        if np.abs(dX).max() <= tol * max(scale, np.abs(X).max()):
+            return P0 + 0.5*(X + X.T), True
+        A = A @ A
+    return P0 + 0.5*(X + X.T), False
+
+
+@jit(nopython=True, cache=True)
+def lyapunov_fast(TT, RQR, P0, tol=1e-12):
+    """
+    Unconditional covariance of the states, P = TT P TT' + RQR.
+
+    Only the states k with a nonzero column in TT (the ones that enter with
+    a lag) matter: P[k, k] solves the Lyapunov equation of 
+    (TT[k, k], RQR[k, k]), and then P = TT[:, k] P[k, k] TT[:, k]' + RQR.
+    The smaller equation is solved by `lyapunov_doubling`, started at 
+    P0[k, k].  Columns of TT below tol relative to its largest element 
+    count as zero (gensys leaves round off error in them).
+    """
+    absTT = np.abs(TT)
+    k = np.nonzero(absTT.sum(axis=0) > tol * absTT.max())[0]
+    TTk = TT[:, k]
+    Pkk, converged = lyapunov_doubling(np.ascontiguousarray(TTk[k, :]),
+                                       np.ascontiguousarray(RQR[k, :][:, k]),
+                                       np.ascontiguousarray(P0[k, :][:, k]), tol)
+    P = TTk @ Pkk @ TTk.T + RQR
+    return 0.5*(P + P.T), converged
+
+
+@jit(nopython=True, cache=True)
+def _forward_substitution(L, b):
+    """Solves L x = b for lower triangular L."""
+    n = b.shape[0]
+    x = np.zeros(n)
+    for i in range(n):
+        x[i] = (b[i] - np.dot(L[i, :i], x[:i])) / L[i, i]
+    return x
+
+
+@jit(nopython=True, cache=True)
+def sqrt_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, P0_is_factor=False):
+    """
+    Square root Kalman filter.
+
+    Propagates the Cholesky factors of the state and forecast error
+    covariances through a QR decomposition of the array
+
+        [ chol(HH)  ZZ chol(Pt)          0 ]
+        [    0      TT chol(Pt)  RR chol(QQ) ],
+
+    so that log det Ft is read off the diagonal of its factor and the
+    forecast errors are standardized by forward substitution.
+
+    If P0_is_factor is True, P0 is taken to be a factor S with P0 = S S'.
+    """
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+    neps = RR.shape[1]
+
+    At = A0
+    Sp = P0.copy() if P0_is_factor else _cholpsd(P0)
+    SpQ = RR @ _cholpsd(QQ)
+    SpH = _cholpsd(HH)
+    DD = DD.flatten()
+
+    loglh = 0.0
+    for i in range(nobs):
+
+        observed = ~np.isnan(y[i])
+        nact = observed.sum()
+
+        ZZo = ZZ[observed, :]
+        if nact == ny:
+            Sh = SpH
+        else:
+            Sh = _cholpsd(HH[observed, :][:, observed])
+
+        pre = np.zeros((nact + ns, nact + ns + neps))
+        pre[:nact, :nact] = Sh
+        pre[:nact, nact:nact+ns] = ZZo @ Sp
+        pre[nact:, nact:nact+ns] = TT @ Sp
+        pre[nact:, nact+ns:] = SpQ
+
+        q, r = np.linalg.qr(pre.T)
+        post = r.T
+
+        Fc = post[:nact, :nact]
+        Kb = post[nact:, :nact]
+        Sp = post[nact:, nact:]
+
+        nut = y[i][observed] - ZZo @ At - DD[observed]
+        et = _forward_substitution(Fc, nut)
+
+        if i >= t0:
+            dFt = 2.0*np.sum(np.log(np.abs(np.diag(Fc))))
+            loglh = loglh - 0.5*nact*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(et, et)
+
+        At = CC + TT @ At + Kb @ et
+
+    return loglh
+
+
+@jit(nopython=True, cache=True)
+def univariate_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0):
+    """
+    Univariate (sequential processing) Kalman filter.
+
+    Observables are incorporated one at a time, see Koopman and Durbin
+    (2000), so every update is a scalar division and missing entries are
+    simply skipped.  Requires a diagonal HH.
+    """
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+
+    for j in range(ny):
+        for k in range(ny):
+            if j != k and HH[j, k] != 0.0:
+                raise ValueError("univariate_kalman requires a diagonal HH.")
+
+    At = A0.copy()
+    Pt = P0.copy()
+    RQR = np.dot(np.dot(RR, QQ), RR.T)
+    DD = DD.flatten()
+
+    loglh = 0.0
+    for i in range(nobs):
+
+        for j in range(ny):
+            if np.isnan(y[i, j]):
+                continue
+
+            zj = ZZ[j]
+            PZ = Pt @ zj
+            Fj = np.dot(zj, PZ) + HH[j, j]
+            vj = y[i, j] - DD[j] - np.dot(zj, At)
+
+            if Fj > 1e-14:
+                Kj = PZ / Fj
+                At = At + Kj * vj
+                Pt = Pt - np.outer(Kj, PZ)
+
+                if i >= t0:
+                    loglh = loglh - 0.5*(np.log(2*np.pi) + np.log(Fj) + vj**2/Fj)
+
+        At = CC + TT @ At
+        Pt = TT @ Pt @ TT.T + RQR
+        Pt = 0.5*(Pt + Pt.T)
+
+    return loglh
+
+
+@jit(nopython=True, cache=True)
+def kalman_filter_grad(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0,
+                       dCC, dTT, dRR, dQQ, dDD, dZZ, dHH, dA0, dP0, t0=0):
+    """
+    Kalman filter log likelihood and its gradient.
+
+    The derivatives of the system matrices (and of A0, P0) with respect
+    to each of npara parameters are stacked along the first axis, and
+    the filter recursion is differentiated alongside the filter itself.
+
+    Returns
+    -------
+    loglh : float
+    grad : np.array (npara)
+    """
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+    npara = dTT.shape[0]
+
+    DD = DD.flatten()
+    RQR = RR @ QQ @ RR.T
+    dRQR = np.zeros((npara, ns, ns))
+    for j in range(npara):
+        x = dRR[j] @ QQ @ RR.T
+        dRQR[j] = x + x.T + RR @ dQQ[j] @ RR.T
+
+    At = A0.copy()
+    Pt = P0.copy()
+    dAt = dA0.copy()
+    dPt = dP0.copy()
+
+    loglh = 0.0
+    grad = np.zeros(npara)
+    for i in range(nobs):
+
+        observed = ~np.isnan(y[i])
+        nact = observed.sum()
+
+        TTPt = TT @ Pt
+
+        if nact > 0:
+            ZZo = np.ascontiguousarray(ZZ[observed, :])
+            nut = y[i][observed] - ZZo @ At - DD[observed]
+
+            PZ = Pt @ ZZo.T
+            Ft = ZZo @ PZ + HH[observed, :][:, observed]
+            Ft = 0.5 * (Ft + Ft.T)
+            iFt = np.linalg.inv(Ft)
+            iFtnut = iFt @ nut
+
+            if i >= t0:
+                dFt = np.log(np.linalg.det(Ft))
+                loglh = loglh - 0.5*nact*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(nut, iFtnut)
+
+            Kt = TTPt @ ZZo.T
+            KiF = Kt @ iFt
+
+            for j in range(npara):
+                dZZo = np.ascontiguousarray(dZZ[j][observed, :])
+                dnut = -dDD[j].flatten()[observed] - dZZo @ At - ZZo @ dAt[j]
+
+                x = dZZo @ PZ
+                dFt = x + x.T + ZZo @ dPt[j] @ ZZo.T + dHH[j][observed, :][:, observed]
+                iFdF = iFt @ dFt
+
+                if i >= t0:
+                    grad[j] = grad[j] - 0.5*(np.trace(iFdF) + 2.0*np.dot(dnut, iFtnut)
+                                             - np.dot(iFtnut, dFt @ iFtnut))
+
+                TTdPt = TT @ dPt[j]
+                dKt = dTT[j] @ PZ + TTdPt @ ZZo.T + TTPt @ dZZo.T
+                diFtnut = iFt @ dnut - iFdF @ iFtnut
+
+                dAt[j] = dCC[j] + dTT[j] @ At + TT @ dAt[j] + dKt @ iFtnut + Kt @ diFtnut
+
+                x = dTT[j] @ TTPt.T
+                z = dKt @ KiF.T
+                dPt[j] = (x + x.T + TTdPt @ TT.T - z - z.T
+                          + KiF @ dFt @ KiF.T + dRQR[j])
+                dPt[j] = 0.5 * (dPt[j] + dPt[j].T)
+
+            At = CC + TT @ At + KiF @ nut
+            Pt = TTPt @ TT.T - KiF @ Kt.T + RQR
+
+        else:
+
+            for j in range(npara):
+                dAt[j] = dCC[j] + dTT[j] @ At + TT @ dAt[j]
+                x = dTT[j] @ TTPt.T
+                dPt[j] = x + x.T + TT @ dPt[j] @ TT.T + dRQR[j]
+
+            At = CC + TT @ At
+            Pt = TTPt @ TT.T + RQR
+
+        Pt = 0.5 * (Pt + Pt.T)
+
+    return loglh, grad
+
+
+def missing_pattern(y):
+    """
+    Summarizes the missing data pattern of a dataset.
+
+    Returns
+    -------
+    pattern : np.array (nobs)
+        Index of the pattern of observed entries in each period.
+    index : np.array (npattern x ny)
+        The observed columns of each pattern, padded with -1.
+    nact : np.array (npattern)
+        The number of observed columns of each pattern.
+    """
+    observed = ~np.isnan(np.asarray(y, dtype=float))
+    masks, pattern = np.unique(observed, axis=0, return_inverse=True)
+
+    npattern, ny = masks.shape
+    index = -np.ones((npattern, ny), dtype=np.int64)
+    nact = masks.sum(1).astype(np.int64)
+    for k in range(npattern):
+        index[k, :nact[k]] = np.flatnonzero(masks[k])
+
+    return pattern.astype(np.int64).reshape(-1), index, nact
+
+
+def _krylov_basis(TT, B, tol=1e-10):
+    """Orthonormal basis of span[B, TT B, TT^2 B, ...] by block Arnoldi."""
+    ns = TT.shape[0]
+    V = np.zeros((ns, 0))
+    block = B
+    scale = max(1.0, np.abs(B).max()) if B.size else 1.0
+    while block.shape[1] > 0 and V.shape[1] < ns:
+        for _ in range(2):
+            block = block - V @ (V.T @ block)
+        U, S, _ = np.linalg.svd(block, full_matrices=False)
+        block = U[:, S > tol*scale]
+        V = np.hstack((V, block))
+        block = TT @ block
+    return V
+
+
+def minimal_realization(CC, TT, RR, ZZ, A0, P0, observable=True, tol=1e-10):
+    """
+    Reduces the state vector to its controllable (and observable) part.
+
+    The controllable subspace is spanned by RR, CC, A0, P0 and their images
+    under powers of TT; the observable subspace of the result is spanned by
+    ZZ' and its images under powers of TT'.  With V an orthonormal basis of
+    the retained subspace, the reduced state V's_t follows
+
+        V's_t = V'CC + (V'TT V) V's_{t-1} + V'RR e_t,   y_t = DD + (ZZ V) V's_t + eta_t
+
+    and gives exactly the same likelihood.  When observable is False,
+    s_t = V V's_t, so the moments of the states can be recovered.
+
+    P0 can be None when it is the unconditional covariance, which lies in
+    the controllable subspace; the unconditional covariance of the reduced
+    system is then V'P0 V, so it can be computed after the reduction.
+
+    Returns
+    -------
+    V : [ns x r] basis of the retained subspace.
+    CC, TT, RR, ZZ, A0, P0 : the reduced system.
+    """
+    # a fixed layout, so the same system always reduces to the same bits
+    TT, RR, ZZ = [np.ascontiguousarray(x, dtype=float) for x in (TT, RR, ZZ)]
+    CC, A0 = np.ravel(CC), np.ravel(A0)
+    B = np.hstack((RR, CC[:, None], A0[:, None]))
+    if P0 is not None:
+        B = np.hstack((B, P0))
+    V = _krylov_basis(TT, B, tol)
+    if observable:
+        TTc = V.T @ TT @ V
+        V = V @ _krylov_basis(TTc.T, (ZZ @ V).T, tol)
+
+    if P0 is not None:
+        P0 = V.T @ P0 @ V
+    return V, V.T @ CC, V.T @ TT @ V, V.T @ RR, ZZ @ V, V.T @ A0, P0
+
+
+def collapse_observations(y, DD, ZZ, HH, t0=0):
+    """
+    Collapses the observables onto a system of dimension rank(ZZ) <= ns.
+
+    With y*_t = L^{-1}(y_t - DD), where HH = LL', and L^{-1}ZZ = U S V', the
+    projection U'y*_t = S V' s_t + e_t, e_t ~ N(0, I) carries all the
+    information about the states (Jungbacker and Koopman, 2008).  The rest of
+    y*_t is pure noise and only enters the likelihood through a correction
+    term that does not depend on the states.
+
+    Returns
+    -------
+    yc : [nobs x r] collapsed observables.
+    DDc, ZZc, HHc : system matrices of the collapsed observables.
+    correction : float
+        log p(y_{t0:T}) - log p(yc_{t0:T}).
+
+    Notes
+    -----
+    Requires HH to be positive definite and y to have no missing values.
+    """
+    y = np.asarray(y, dtype=float)
+    nobs, ny = y.shape
+
+    if np.isnan(y).any():
+        raise ValueError('Cannot collapse observations with missing values.')
+
+    HH = np.atleast_2d(np.asarray(HH, dtype=float))
+    w = np.linalg.eigvalsh(HH)
+    if w[0] <= ny * np.finfo(float).eps * max(abs(w).max(), 1.0):
+        raise ValueError('Cannot collapse observations: HH is singular or not '
+                         'positive definite, smallest eigenvalue %g.' % w[0])
+
+    L = np.linalg.cholesky(HH)
+    ystar = solve_triangular(L, (y - np.asarray(DD).flatten()).T, lower=True)
+    Zstar = solve_triangular(L, ZZ, lower=True)
+
+    U, S, Vt = np.linalg.svd(Zstar, full_matrices=False)
+    r = np.sum(S > S.max() * max(Zstar.shape) * np.finfo(float).eps) if S.size else 0
+    U, S, Vt = U[:, :r], S[:r], Vt[:r]
+
+    yc = U.T @ ystar
+    e = ystar - U @ yc
+
+    e = e[:, t0:]
+    correction = (- (nobs-t0)*np.log(np.diag(L)).sum()
+                  - 0.5*(nobs-t0)*(ny-r)*np.log(2*np.pi)
+                  - 0.5*(e**2).sum())
+
+    return (np.ascontiguousarray(yc.T), np.zeros((r, 1)), S[:, None]*Vt,
+            np.eye(r), correction)
+
+
+@jit(nopython=True, cache=True)
+def _chand_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH, At, Pt,
+                  Ft, iFt, Kt, St, Mt, chand, pattern, index, nact, t0=0):
+    """
+    Hybrid Chandrasekhar / Kalman recursion.
+
+    Runs the Chandrasekhar recursion over periods with complete data and
+    the standard covariance update over periods with missing entries.
+    Unlike `chand_recursion`, Pt is tracked through the Chandrasekhar
+    runs (P_{t+1} = P_t + St Mt St') so that the filter can switch back
+    and forth, and the low rank factorization of P_{t+1} - P_t is
+    recomputed whenever a run of complete data starts.
+    """
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+
+    RQR = np.dot(np.dot(RR, QQ), RR.T)
+    DD = DD.flatten()
+
+    loglh = 0.0
+    for i in range(nobs):
+
+        k = pattern[i]
+        nk = nact[k]
+
+        if nk == ny:
+
+            if not chand:
+                # start of a run of complete data
+                Ft = ZZ @ Pt @ ZZ.T + HH
+                Ft = 0.5 * (Ft + Ft.T)
+                iFt = np.linalg.inv(Ft)
+                TTPt = TT @ Pt
+                Kt = TTPt @ ZZ.T @ iFt
+                dPt = TTPt @ TT.T - Kt @ Ft @ Kt.T + RQR - Pt
+                dPt = 0.5 * (dPt + dPt.T)
+                lam, V = np.linalg.eigh(dPt)
+                keep = np.abs(lam) > 1e-10*max(np.max(np.abs(lam)), 1e-300)
+                St = np.ascontiguousarray(V[:, keep])
+                Mt = np.diag(lam[keep])
+                chand = True
+
+            nut = y[i] - ZZ @ At - DD
+
+            dFt = np.log(np.linalg.det(Ft))
+            iFtnut = iFt @ nut
+
+            if i >= t0:
+                loglh = loglh - 0.5*ny*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(nut, iFtnut)
+
+            At = CC + TT @ At + Kt @ nut
+            Pt = Pt + St @ Mt @ St.T
+
+            ZZSt = ZZ @ St
+            MSpZp = Mt @ ZZSt.T
+            TTSt = TT @ St
+
+            Ft1 = Ft + ZZSt @ MSpZp
+            Ft1 = 0.5 * (Ft1 + Ft1.T)
+            iFt1 = np.linalg.inv(Ft1)
+
+            Kt = (Kt @ Ft + TTSt @ MSpZp) @ iFt1
+            St = TTSt - Kt @ ZZSt
+            Mt = Mt + MSpZp @ iFt @ MSpZp.T
+            Mt = 0.5 * (Mt + Mt.T)
+            Ft = Ft1
+            iFt = iFt1
+
+        else:
+
+            chand = False
+            obs = index[k, :nk]
+
+            TTPt = TT @ Pt
+            if nk > 0:
+                ZZo = ZZ[obs, :]
+                nut = y[i][obs] - ZZo @ At - DD[obs]
+
+                Fo = ZZo @ Pt @ ZZo.T + HH[obs, :][:, obs]
+                Fo = 0.5 * (Fo + Fo.T)
+
+                dFt = np.log(np.linalg.det(Fo))
+                iFtnut = np.linalg.solve(Fo, nut)
+
+                if i >= t0:
+                    loglh = loglh - 0.5*nk*np.log(2*np.pi) - 0.5*dFt - 0.5*np.dot(nut, iFtnut)
+
+                Ko = TTPt @ ZZo.T
+                At = CC + TT @ At + Ko @ iFtnut
+                Pt = TTPt @ TT.T - Ko @ np.linalg.solve(Fo, Ko.T) + RQR
+            else:
+                At = CC + TT @ At
+                Pt = TTPt @ TT.T + RQR
+
+            Pt = 0.5 * (Pt + Pt.T)
+
+    return loglh, At, Pt, Ft, iFt, Kt, St, Mt, chand
+
+
+def chand_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, pattern=None,
+                 return_state=False):
+    """
+    Hybrid Chandrasekhar / Kalman filter for data with missing values.
+
+    Parameters
+    ----------
+    pattern : tuple, optional
+        The output of `missing_pattern(y)`, which can be computed once and
+        reused across calls.  Computed from y if not given.
+    return_state : bool, optional
+        Also return the mean and covariance of the states in the period 
+        after the last observation, given all the observations.
+    """
+    if pattern is None:
+        pattern = missing_pattern(y)
+
+    ny = ZZ.shape[0]
+    ns = TT.shape[0]
+
+    res = _chand_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH,
+                        np.asarray(A0, dtype=float).copy(),
+                        np.asarray(P0, dtype=float).copy(),
+                        np.zeros((ny, ny)), np.zeros((ny, ny)),
+                        np.zeros((ns, ny)), np.zeros((ns, ny)), np.zeros((ny, ny)),
+                        False, pattern[0], pattern[1], pattern[2], t0)
+    if return_state:
+        return res[0], res[1], res[2]
+    return res[0]
+
+
+@jit(nopython=True, cache=True)
+def _scan_element(y, CC, TT, RQR, DD, ZZ, HH, m, P):
+    """
+    Element (A, b, C, eta, J) of the parallel Kalman filter of Sarkka and
+    Garcia-Fernandez (2021) for a single period, with s|s_{-1} ~ N(m + TT s_{-1}, P).
+    """
+    ns = TT.shape[0]
+    observed = ~np.isnan(y)
+
+    if np.sum(observed) == 0:
+        return TT.copy(), m.copy(), P.copy(), np.zeros(ns), np.zeros((ns, ns))
+
+    ZZo = ZZ[observed, :]
+    nut = y[observed] - ZZo @ m - DD[observed]
+    PZ = P @ ZZo.T
+    St = ZZo @ PZ + HH[observed, :][:, observed]
+    St = 0.5*(St + St.T)
+
+    Kt = np.linalg.solve(St, PZ.T).T
+    iStZTT = np.linalg.solve(St, ZZo @ TT)
+
+    A = TT - Kt @ (ZZo @ TT)
+    b = m + Kt @ nut
+    C = P - Kt @ PZ.T
+    eta = iStZTT.T @ nut
+    J = (ZZo @ TT).T @ iStZTT
+    return A, b, 0.5*(C + C.T), eta, 0.5*(J + J.T)
+
+
+@jit(nopython=True, cache=True)
+def _scan_combine(Ai, bi, Ci, etai, Ji, Aj, bj, Cj, etaj, Jj):
+    """Associative combination of two parallel Kalman filter elements, i before j."""
+    X = np.eye(Ai.shape[0]) + Ci @ Jj
+
+    A = Aj @ np.linalg.solve(X, Ai)
+    b = Aj @ np.linalg.solve(X, bi + Ci @ etaj) + bj
+    C = Aj @ np.linalg.solve(X, Ci) @ Aj.T + Cj
+    eta = Ai.T @ np.linalg.solve(X.T, etaj - Jj @ bi) + etai
+    J = Ai.T @ np.linalg.solve(X.T, Jj @ Ai) + Ji
+    return A, b, 0.5*(C + C.T), eta, 0.5*(J + J.T)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _parallel_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0, bounds):
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+    nchunks = bounds.size - 1
+
+    DD = DD.flatten()
+    RQR = RR @ QQ @ RR.T
+
+    # 1. reduce each chunk to a single element
+    Ac = np.zeros((nchunks, ns, ns))
+    bc = np.zeros((nchunks, ns))
+    Cc = np.zeros((nchunks, ns, ns))
+    etac = np.zeros((nchunks, ns))
+    Jc = np.zeros((nchunks, ns, ns))
+    for c in prange(nchunks):
+        i0 = bounds[c]
+        if c == 0:
+            A, b, C, eta, J = _scan_element(y[0], CC, np.zeros((ns, ns)), RQR, DD, ZZ, HH, A0, P0)
+        else:
+            A, b, C, eta, J = _scan_element(y[i0], CC, TT, RQR, DD, ZZ, HH, CC, RQR)
+        for i in range(i0+1, bounds[c+1]):
+            Aj, bj, Cj, etaj, Jj = _scan_element(y[i], CC, TT, RQR, DD, ZZ, HH, CC, RQR)
+            A, b, C, eta, J = _scan_combine(A, b, C, eta, J, Aj, bj, Cj, etaj, Jj)
+        Ac[c], bc[c], Cc[c], etac[c], Jc[c] = A, b, C, eta, J
+
+    # 2. filtered states at the end of each chunk
+    mc = np.zeros((nchunks, ns))
+    Pc = np.zeros((nchunks, ns, ns))
+    mc[0], Pc[0] = bc[0], Cc[0]
+    for c in range(1, nchunks):
+        A, b, C, eta, J = _scan_combine(np.zeros((ns, ns)), mc[c-1], Pc[c-1], np.zeros(ns),
+                                        np.zeros((ns, ns)), Ac[c], bc[c], Cc[c], etac[c], Jc[c])
+        mc[c], Pc[c] = b, C
+
+    # 3. the likelihood, filtering each chunk from the end of the previous one
+    loglhc = np.zeros(nchunks)
+    for c in prange(nchunks):
+        if c == 0:
+            At = A0.copy()
+            Pt = P0.copy()
+        else:
+            At = CC + TT @ mc[c-1]
+            Pt = TT @ Pc[c-1] @ TT.T + RQR
+
+        loglh = 0.0
+        for i in range(bounds[c], bounds[c+1]):
+            observed = ~np.isnan(y[i])
+            nact = np.sum(observed)
+            if nact > 0:
+                ZZo = ZZ[observed, :]
+                nut = y[i][observed] - ZZo @ At - DD[observed]
+                PZ = Pt @ ZZo.T
+                Ft = ZZo @ PZ + HH[observed, :][:, observed]
+                Ft = 0.5*(Ft + Ft.T)
+                iFtnut = np.linalg.solve(Ft, nut)
+                if i >= t0:
+                    loglh += (- 0.5*nact*np.log(2*np.pi) - 0.5*np.log(np.linalg.det(Ft))
+                              - 0.5*np.dot(nut, iFtnut))
+                At = At + PZ @ iFtnut
+                Pt = Pt - PZ @ np.linalg.solve(Ft, PZ.T)
+            At = CC + TT @ At
+            Pt = TT @ Pt @ TT.T + RQR
+            Pt = 0.5*(Pt + Pt.T)
+        loglhc[c] = loglh
+
+    return loglhc.sum()
+
+
+def parallel_kalman(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, nchunks=None):
+    """
+    Kalman filter likelihood evaluated in parallel over chunks of the sample.
+
+    Each chunk of periods is reduced to a single element of the associative
+    filtering operator of Sarkka and Garcia-Fernandez (2021); the elements
+    are combined sequentially to get the filtered state at the start of each
+    chunk, and the chunks are then filtered in parallel.  On one core the
+    total work is four to seven times that of `kalman_filter`, depending on
+    nchunks (see benchmarks/parallel_kalman.py), so this only pays off for
+    very long samples on several cores.
+
+    Parameters
+    ----------
+    nchunks : int, optional
+        Number of chunks.  The default is the number of numba threads.
+
+    Notes
+    -----
+    Requires Z RQR' Z' + HH to be nonsingular for the observed variables.
+    """
+    nobs = y.shape[0]
+    if nchunks is None:
+        nchunks = get_num_threads()
+    nchunks = max(1, min(nchunks, nobs))
+    bounds = np.linspace(0, nobs, nchunks+1).astype(np.int64)
+
+    return _parallel_kalman(np.asarray(y, dtype=float), CC, TT, RR, QQ,
+                            np.asarray(DD, dtype=float), ZZ, HH,
+                            np.asarray(A0, dtype=float), np.asarray(P0, dtype=float),
+                            t0, bounds)
+
+
+@jit(nopython=True, cache=True)
+def chand_recursion_batch(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, ss_tol=0.0):
+    """
+    Runs `chand_recursion` over a stack of systems.
+
+    The system matrices (and A0, P0) carry an extra leading dimension
+    indexing the parameter draws; the data are common to all draws.
+    """
+    ndraws = TT.shape[0]
+    loglh = np.zeros(ndraws)
+    for j in range(ndraws):
+        loglh[j] = chand_recursion(y, CC[j], TT[j], RR[j], QQ[j], DD[j],
+                                   ZZ[j], HH[j], A0[j], P0[j], t0, ss_tol)
+    return loglh
+
+
+@jit(nopython=True, cache=True)
+def kalman_filter_batch(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, ss_tol=0.0):
+    """
+    Runs `kalman_filter` over a stack of systems.
+
+    The system matrices (and A0, P0) carry an extra leading dimension
+    indexing the parameter draws; the data are common to all draws.
+    """
+    ndraws = TT.shape[0]
+    loglh = np.zeros(ndraws)
+    for j in range(ndraws):
+        loglh[j] = kalman_filter(y, CC[j], TT[j], RR[j], QQ[j], DD[j],
+                                 ZZ[j], HH[j], A0[j], P0[j], t0, ss_tol)
+    return loglh
+
+
+def chand_kalman_batch(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, t0=0, pattern=None):
+    """
+    Runs `chand_kalman` over a stack of systems, with the missing data
+    pattern computed once for all draws.
+    """
+    if pattern is None:
+        pattern = missing_pattern(y)
+
+    ndraws = TT.shape[0]
+    loglh = np.zeros(ndraws)
+    for j in range(ndraws):
+        loglh[j] = chand_kalman(y, CC[j], TT[j], RR[j], QQ[j], DD[j],
+                                ZZ[j], HH[j], A0[j], P0[j], t0, pattern=pattern)
+    return loglh
+
+
+@jit(nopython=True, cache=True)
+def simulation_smoother(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0, z0, zeps, zeta):
+    """
+    Durbin and Koopman (2002) simulation smoother.
+
+    Draws M paths of the states and the shocks from p(s_{1:T}, e_{1:T}|Y).
+    Each draw is s+ + E[s|y - y+], where (s+, e+, y+) are simulated from the
+    model and the smoothing is done with the zero intercept system.  The
+    gains do not depend on the data, so they are computed once and the mean
+    recursions are run on all M datasets at the same time.
+
+    Parameters
+    ----------
+    z0 : [M x ns] array of standard normal draws for the initial state.
+    zeps : [M x nobs x neps] array of standard normal draws for the shocks.
+    zeta : [M x nobs x ny] array of standard normal draws for the measurement errors.
+
+    Returns
+    -------
+    states : [M x nobs x ns] array of draws of the states.
+    shocks : [M x nobs x neps] array of draws of the shocks.
+
+    Notes
+    -----
+    The first period shock is drawn from its distribution conditional on
+    s_1 ~ N(A0, P0), which requires P0 - RQR' to be positive semi-definite
+    (true for the unconditional covariance).
+    """
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+    neps = QQ.shape[0]
+    M = z0.shape[0]
+
+    DD = DD.flatten()
+    RQR = RR @ QQ @ RR.T
+    QR = QQ @ RR.T
+
+    # simulate from the model
+    cQ = _cholpsd(QQ)
+    cH = _cholpsd(HH)
+    cP0 = _cholpsd(P0)
+
+    B = QR @ np.linalg.pinv(P0)
+    cQ1 = _cholpsd(QQ - B @ QR.T)
+
+    observed = ~np.isnan(y)
+    splus = np.zeros((nobs, ns, M))
+    eplus = np.zeros((nobs, neps, M))
+    ystar = np.zeros((nobs, ny, M))
+
+    x = cP0 @ z0.T
+    eplus[0] = B @ x + cQ1 @ zeps[:, 0, :].T
+    splus[0] = x + A0.reshape((ns, 1))
+    for i in range(1, nobs):
+        eplus[i] = cQ @ zeps[:, i, :].T
+        splus[i] = TT @ splus[i-1] + RR @ eplus[i] + CC.reshape((ns, 1))
+
+    for i in range(nobs):
+        yplus = ZZ @ splus[i] + cH @ zeta[:, i, :].T
+        for j in range(ny):
+            if observed[i, j]:
+                ystar[i, j] = y[i, j] - DD[j] - yplus[j]
+
+    # gains, computed once
+    Kt_all = np.zeros((nobs, ns, ny))
+    iFt_all = np.zeros((nobs, ny, ny))
+    Pt = P0.copy()
+    for i in range(nobs):
+        nact = np.sum(observed[i])
+        if nact > 0:
+            ZZo = ZZ[observed[i], :]
+            PZ = Pt @ ZZo.T
+            Ft = ZZo @ PZ + HH[observed[i], :][:, observed[i]]
+            iFt = np.linalg.inv(0.5*(Ft + Ft.T))
+            Kt = PZ @ iFt
+            Kt_all[i][:, :nact] = Kt
+            iFt_all[i][:nact, :nact] = iFt
+            Pt = Pt - Kt @ PZ.T
+        Pt = TT @ Pt @ TT.T + RQR
+        Pt = 0.5*(Pt + Pt.T)
+
+    # forecast errors of the zero intercept system for all datasets
+    ut = np.zeros((nobs, ny, M))
+    At = np.zeros((ns, M))
+    for i in range(nobs):
+        nact = np.sum(observed[i])
+        if nact > 0:
+            ZZo = ZZ[observed[i], :]
+            nut = ystar[i][observed[i]] - ZZo @ At
+            ut[i][:nact] = iFt_all[i][:nact, :nact] @ nut
+            At = At + Kt_all[i][:, :nact] @ nut
+        At = TT @ At
+
+    # disturbance smoother
+    rt = np.zeros((ns, M))
+    rprev = np.zeros((nobs, ns, M))
+    for i in range(nobs-1, -1, -1):
+        nact = np.sum(observed[i])
+        ZZo = ZZ[observed[i], :]
+        TTr = TT.T @ rt
+        rt = ZZo.T @ ut[i][:nact] + TTr - ZZo.T @ (Kt_all[i][:, :nact].T @ TTr)
+        rprev[i] = rt
+
+    states = np.zeros((M, nobs, ns))
+    shocks = np.zeros((M, nobs, neps))
+    st = P0 @ rprev[0]
+    for i in range(nobs):
+        if i > 0:
+            st = TT @ st + RQR @ rprev[i]
+        states[:, i, :] = (splus[i] + st).T
+        shocks[:, i, :] = (eplus[i] + QR @ rprev[i]).T
+
+    return states, shocks
+
+
+@jit(nopython=True, cache=True)
+def simulate_paths(CC, TT, RR, DD, ZZ, s0, eps, eta, burn=0, return_states=False):
+    """
+    Simulates M paths of
+
+        s_t = CC + TT s_{t-1} + RR eps_t,   y_t = DD + ZZ s_t + eta_t.
+
+    Parameters
+    ----------
+    s0 : [M x ns] array of initial states.
+    eps : [M x nsim x neps] array of shocks.
+    eta : [M x nsim x ny] array of measurement errors.
+    burn : int, optional
+        Number of initial periods to discard.
+    return_states : bool, optional
+        Also store the states.
+
+    Returns
+    -------
+    ysim : [M x (nsim-burn) x ny] array of observables.
+    ssim : [M x (nsim-burn) x ns] array of states, with a zero length first
+        dimension unless return_states is True.
+    """
+    M, nsim, neps = eps.shape
+    ns = TT.shape[0]
+    ny = ZZ.shape[0]
+    DD = DD.flatten()
+
+    ysim = np.zeros((M, nsim-burn, ny))
+    ssim = np.zeros((M if return_states else 0, nsim-burn, ns))
+
+    # paths are the rows of st, so the recursion is st TT' + eps RR'
+    TTt = np.ascontiguousarray(TT.T)
+    RRt = np.ascontiguousarray(RR.T)
+    ZZt = np.ascontiguousarray(ZZ.T)
+
+    st = s0.copy()
+    for t in range(nsim):
+        st = st @ TTt + np.ascontiguousarray(eps[:, t, :]) @ RRt + CC
+        if t >= burn:
+            ysim[:, t-burn, :] = st @ ZZt + eta[:, t, :] + DD
+            if return_states:
+                ssim[:, t-burn, :] = st
+
+    return ysim, ssim
+
+
+@jit(nopython=True, cache=True)
+def disturbance_smoother(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0):
+    """
+    Smoothed means of the states and the shocks, E[s_t|Y] and E[e_t|Y].
+
+    This is `simulation_smoother` with all draws set to zero, which leaves
+    the smoothing of the data alone.
+
+    Returns
+    -------
+    states : [nobs x ns] array of smoothed states.
+    shocks : [nobs x neps] array of smoothed shocks.
+    """
+    nobs, ny = y.shape
+    ns = TT.shape[0]
+    neps = QQ.shape[0]
+
+    states, shocks = simulation_smoother(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0,
+                                         np.zeros((1, ns)), np.zeros((1, nobs, neps)),
+                                         np.zeros((1, nobs, ny)))
+    return states[0], shocks[0]
+
+
+@jit(nopython=True, cache=True)
+def shock_decomposition(CC, TT, RR, s1, eps):
+    """
+    Decomposes the path s_t = CC + TT s_{t-1} + RR eps_t, t = 2, ..., T,
+    starting at s_1, into the contributions of each shock and of the
+    initial conditions.
+
+    The shock contributions are one recursion on the [ns x neps] matrix
+    X_t = TT X_{t-1} + RR diag(eps_t), whose columns are the shocks.
+
+    Parameters
+    ----------
+    s1 : [ns] array, the first state.
+    eps : [nobs x neps] array of shocks.
+
+    Returns
+    -------
+    contrib : [nobs x ns x (neps+1)] array; the last column is the
+        initial conditions, TT^{t-1} (s_1 - RR eps_1) plus the accumulated
+        constant.  The columns sum to s_t.
+    """
+    nobs, neps = eps.shape
+    ns = TT.shape[0]
+
+    contrib = np.zeros((nobs, ns, neps+1))
+    X = RR * eps[0]
+    init = s1 - RR @ eps[0]
+    for t in range(nobs):
+        if t > 0:
+            X = TT @ X + RR * eps[t]
+            init = TT @ init + CC
+        contrib[t, :, :neps] = X
+        contrib[t, :, neps] = init
+
+    return contrib
+
+
+@jit(nopython=True, cache=True)
+def triangular_resolvent(S, B, z):
+    """
+    Computes (I - z_f S)^{-1} B for every z_f in z, with S upper triangular,
+    by back substitution on all of z at once.
+
+    Parameters
+    ----------
+    S : [n x n] complex upper triangular array, e.g. a complex Schur form.
+    B : [n x m] complex array.
+    z : [nfreq] complex array.
+
+    Returns
+    -------
+    X : [nfreq x n x m] complex array.
+    """
+    n, m = B.shape
+    nfreq = z.shape[0]
+
+    X = np.zeros((nfreq, n, m), dtype=np.complex128)
+    for f in range(nfreq):
+        for i in range(n-1, -1, -1):
+            d = 1.0 / (1.0 - z[f] * S[i, i])
+            for k in range(m):
+                acc = 0.0j
+                for j in range(i+1, n):
+                    acc += S[i, j] * X[f, j, k]
+                X[f, i, k] = (B[i, k] + z[f] * acc) * d
+
+    return X
+
+
+@jit(nopython=True, cache=True)
+def conditional_smoother(y, CC, TT, RR, QQ, DD, ZZ, HH, A0, P0):
+    """
+    Smoothed means of the states over a window of h periods, for M datasets
+    with the same missing pattern, starting from s_1 ~ N(A0, P0).
+
+    The gains depend only on the pattern, so they are computed once and the
+    filter and smoother mean recursions run on all M datasets together.
+
+    Parameters
+    ----------
+    y : [M x h x ny] array, NaN where not observed.  The pattern of y[0] is
+        used for all datasets.
+    HH : [h x ny x ny] array of (time varying) measurement error covariances.
+
+    Returns
+    -------
+    states : [M x h x ns] array of E[s_t|y_{1:h}].
+    """
+    M, h, ny = y.shape
+    ns = TT.shape[0]
+
+    DD = DD.flatten()
+    RQR = RR @ QQ @ RR.T
+    observed = ~np.isnan(y[0])
+
+    # gains, computed once
+    Pt_all = np.zeros((h, ns, ns))
+    Kt_all = np.zeros((h, ns, ny))
+    iFt_all = np.zeros((h, ny, ny))
+    Pt = P0.copy()
+    for t in range(h):
+        Pt_all[t] = Pt
+        obs = np.nonzero(observed[t])[0]
+        nact = obs.size
+        if nact > 0:
+            ZZo = ZZ[obs, :]
+            Ft = ZZo @ Pt @ ZZo.T + HH[t][obs, :][:, obs]
+            iFt = np.linalg.inv(0.5*(Ft + Ft.T))
+            Kt = TT @ Pt @ ZZo.T @ iFt
+            Kt_all[t][:, :nact] = Kt
+            iFt_all[t][:nact, :nact] = iFt
+            Pt = TT @ Pt @ (TT - Kt @ ZZo).T + RQR
+        else:
+            Pt = TT @ Pt @ TT.T + RQR
+        Pt = 0.5*(Pt + Pt.T)
+
+    # predicted states and forecast errors of all datasets
+    At_all = np.zeros((h, ns, M))
+    ut = np.zeros((h, ny, M))
+    At = np.zeros((ns, M))
+    for m in range(M):
+        At[:, m] = A0
+    for t in range(h):
+        At_all[t] = At
+        obs = np.nonzero(observed[t])[0]
+        nact = obs.size
+        nut = np.zeros((nact, M))
+        for j in range(nact):
+            for m in range(M):
+                nut[j, m] = y[m, t, obs[j]] - DD[obs[j]]
+        if nact > 0:
+            nut = nut - ZZ[obs, :] @ At
+            ut[t][:nact] = iFt_all[t][:nact, :nact] @ nut
+        At = TT @ At + Kt_all[t][:, :nact] @ nut
+        for m in range(M):
+            At[:, m] += CC
+
+    # r_{t-1} = Z' F^{-1} v_t + L_t' r_t,  E[s_t|y] = a_t + P_t r_{t-1}
+    states = np.zeros((M, h, ns))
+    rt = np.zeros((ns, M))
+    for t in range(h-1, -1, -1):
+        obs = np.nonzero(observed[t])[0]
+        nact = obs.size
+        ZZo = ZZ[obs, :]
+        TTr = TT.T @ rt
+        rt = ZZo.T @ ut[t][:nact] + TTr - ZZo.T @ (Kt_all[t][:, :nact].T @ rt)
+        st = At_all[t] + Pt_all[t] @ rt
+        for m in range(M):
+            states[m, t] = st[:, m]
+
+    return states
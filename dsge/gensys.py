@@ -116,3 +116,116 @@ def gensys(G0, G1, PSI, PI, DIV=1 + 1e-8,
 
     else:
         return G1, impact, RC
+
+
+def gensys_derivative(G0, G1, PSI, PI, dG0, dG1, dPSI, dPI, REALSMALL=1e-6):
+    """
+    Derivatives of the GENSYS solution with respect to parameters.
+
+    Given the derivatives of Γ₀, Γ₁, Ψ, Π with respect to each of npara
+    parameters (stacked along the first axis), computes the first-order
+    perturbation of the ordered QZ decomposition: the perturbed stable
+    deflating subspaces solve a coupled generalized Sylvester equation,
+    which is triangular in the QZ coordinates.
+
+    Returns
+    -------
+    TT : 2d array
+         The solution restricted to the stable subspace, TT Z₁Z₁ᴴ.  It
+         agrees with the GENSYS TT on every state reachable by the
+         model, so it yields the same likelihood.
+    RR : 2d array
+    dTT : 3d array (npara x n x n)
+    dRR : 3d array (npara x n x neps)
+    RC : 2d int array, see `gensys`
+
+    Notes
+    -----
+    The derivative only exists under existence and uniqueness
+    (RC = [1, 1]); otherwise TT and RR are returned as NaN.
+    """
+    from scipy.linalg import solve_triangular
+
+    n = G0.shape[0]
+    npara = dG0.shape[0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        AA, BB, alpha, beta, Q, Z = ordqz(G0, G1, sort='ouc', output='complex')
+        x = alpha / beta
+        nunstab = (x * x.conjugate() < 1.0).sum()
+
+    k = n - nunstab
+
+    # Q here is the left transformation: G0 = Q AA Z^H
+    Pit = Q.conj().T.dot(PI)
+    Psit = Q.conj().T.dot(PSI)
+    Pi1, Pi2 = Pit[:k], Pit[k:]
+    Psi1, Psi2 = Psit[:k], Psit[k:]
+
+    ueta, deta, veta = svd(Pi2, full_matrices=False)
+    bigev = deta > REALSMALL
+    Pi2inv = (veta[bigev, :].conj().T / deta[bigev]).dot(ueta[:, bigev].conj().T)
+
+    RC = np.array([0, 0])
+    RC[0] = bigev.sum() >= nunstab
+    Phi = Pi1.dot(Pi2inv)
+    RC[1] = np.allclose(Phi.dot(Pi2), Pi1, atol=REALSMALL)
+
+    ns, neps = G0.shape[0], PSI.shape[1]
+    if not (RC[0] and RC[1]):
+        return (np.nan*np.ones((n, n)), np.nan*np.ones((n, neps)),
+                np.zeros((npara, n, n)), np.zeros((npara, n, neps)), RC)
+
+    A11, A12, A22 = AA[:k, :k], AA[:k, k:], AA[k:, k:]
+    B11, B12, B22 = BB[:k, :k], BB[:k, k:], BB[k:, k:]
+    Z1, Z2 = Z[:, :k], Z[:, k:]
+
+    Lam = solve_triangular(A11, B11)
+    G = solve_triangular(A11, Psi1 - Phi.dot(Psi2))
+
+    TT = np.real(Z1.dot(Lam).dot(Z1.conj().T))
+    RR = np.real(Z1.dot(G))
+
+    QH = Q.conj().T
+    dA = QH @ dG0 @ Z
+    dB = QH @ dG1 @ Z
+    dPsit = QH @ dPSI
+    dPit = QH @ dPI
+
+    # coupled Sylvester equation, column by column:
+    #    A22 Y - X A11 = -dA21
+    #    B22 Y - X B11 = -dB21
+    m = n - k
+    X = np.zeros((npara, m, k), dtype=complex)
+    Y = np.zeros((npara, m, k), dtype=complex)
+    for j in range(k):
+        r1 = -dA[:, k:, j] + X[:, :, :j] @ A11[:j, j]
+        r2 = -dB[:, k:, j] + X[:, :, :j] @ B11[:j, j]
+        a, b = A11[j, j], B11[j, j]
+        y = solve_triangular(b*A22 - a*B22, (b*r1 - a*r2).T)
+        Y[:, :, j] = y.T
+        if np.abs(a) >= np.abs(b):
+            X[:, :, j] = (A22.dot(y).T - r1) / a
+        else:
+            X[:, :, j] = (B22.dot(y).T - r2) / b
+
+    XH = np.conj(np.swapaxes(X, 1, 2))
+    dA11 = dA[:, :k, :k] + A12 @ Y
+    dB11 = dB[:, :k, :k] + B12 @ Y
+    dPsi1 = dPsit[:, :k] + XH @ Psi2
+    dPsi2 = dPsit[:, k:] - X @ Psi1
+    dPi1 = dPit[:, :k] + XH @ Pi2
+    dPi2 = dPit[:, k:] - X @ Pi1
+
+    A11inv = solve_triangular(A11, np.eye(k))
+    dLam = A11inv @ (dB11 - dA11 @ Lam)
+    dPhi = (dPi1 - Phi @ dPi2) @ Pi2inv
+    dG = A11inv @ (dPsi1 - dPhi @ Psi2 - Phi @ dPsi2 - dA11 @ G)
+
+    Z1H = Z1.conj().T
+    Z2YLam = Z2 @ Y @ Lam
+    dTT = (Z2YLam @ Z1H + Z1 @ dLam @ Z1H
+           + Z1 @ Lam @ np.conj(np.swapaxes(Y, 1, 2)) @ Z2.conj().T)
+    dRR = Z1 @ dG + Z2 @ Y @ G
+
+    return TT, RR, np.real(dTT), np.real(dRR), RC
@@ -96,6 +96,114 @@ class TestFilter(TestCase):
         self.assertAlmostEqual(0, 0)
 
 
+    def test_kf_everything_output(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        y = model.yy.values.copy()
+        y[10, 0] = np.nan
+        y[20, :] = np.nan
+
+        means = model.kf_everything(p0, y=y, output='means')
+        stds = model.kf_everything(p0, y=y)
+        full = model.kf_everything(p0, y=y, output='cov')
+
+        self.assertNotIn('smoothed_stds', means)
+        self.assertNotIn('smoothed_cov', stds)
+        assert_allclose(means['smoothed_means'], full['smoothed_means'])
+        # states with zero variance have stds at the level of roundoff
+        assert_allclose(stds['smoothed_stds'], full['smoothed_stds'], atol=1e-8)
+
+        # no [nobs x ns x ns] arrays without output='cov'
+        from dsge.filters import filter_and_smooth
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+        P0 = model.initial_covariance(TT, RR, QQ)
+        res = filter_and_smooth(*model._filter_inputs(y, CC, TT, RR, QQ, DD, ZZ, HH,
+                                                      np.zeros(TT.shape[0]), P0), output=1)
+        self.assertEqual([x.shape[0] for x in res[3::3]], [0, 0, 0])
+
+        # Rauch-Tung-Striebel smoother as a check
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+        fm, fc = full['filtered_means'].values, full['filtered_cov']
+        am, pc = full['forecast_means'].values, full['forecast_cov']
+        sm, sv = fm[-1], fc[-1]
+        for t in range(y.shape[0]-2, -1, -1):
+            J = fc[t] @ TT.T @ np.linalg.pinv(pc[t+1])
+            sm = fm[t] + J @ (sm - am[t+1])
+            sv = fc[t] + J @ (sv - pc[t+1]) @ J.T
+            assert_allclose(full['smoothed_means'].values[t], sm, atol=1e-8)
+            assert_allclose(full['smoothed_cov'][t], sv, atol=1e-8)
+
+    def test_simulation_smoother(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        y = model.yy.values.copy()
+        y[10, 0] = np.nan
+        y[20, :] = np.nan
+
+        draws = model.simulation_smoother(p0, ndraws=4000, y=y, seed=1234)
+        states, shocks = draws['states'], draws['shocks']
+
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+        self.assertEqual(states.shape, (4000, y.shape[0], TT.shape[0]))
+        self.assertEqual(shocks.shape, (4000, y.shape[0], QQ.shape[0]))
+
+        # each draw satisfies the model equations
+        resid = states[:, 1:] - states[:, :-1] @ TT.T - shocks[:, 1:] @ RR.T - CC
+        assert_allclose(resid, 0, atol=1e-8)
+        yfit = states @ ZZ.T + np.asarray(DD).flatten()
+        obs = ~np.isnan(y)
+        assert_allclose(yfit[:, obs], np.tile(y[obs], (4000, 1)), atol=1e-8)
+
+        # and the draws are centered on the smoothed means
+        res = model.kf_everything(p0, y=y)
+        scale = res['smoothed_stds'].values.max()
+        assert_allclose(states.mean(0), res['smoothed_means'].values, atol=0.05*scale)
+
+    def test_simulation_smoother_scalar_model(self):
+        from dsge.StateSpaceModel import StateSpaceModel
+
+        np.random.seed(1848)
+        yy = np.random.randn(50)
+        yy[5] = np.nan
+        model = StateSpaceModel(yy,
+                                CC=lambda p: 0.0,
+                                TT=lambda p: p[0],
+                                RR=lambda p: 1.0,
+                                QQ=lambda p: 1.0,
+                                DD=lambda p: 0.0,
+                                ZZ=lambda p: 1.0,
+                                HH=lambda p: p[1])
+
+        para = [0.9, 0.5]
+        draws = model.simulation_smoother(para, ndraws=2000, seed=1234)
+        self.assertEqual(draws['states'].shape, (2000, 50, 1))
+        self.assertEqual(draws['shocks'].shape, (2000, 50, 1))
+
+        res = model.kf_everything(para)
+        scale = res['smoothed_stds'].values.max()
+        assert_allclose(draws['states'].mean(0), res['smoothed_means'].values, atol=0.1*scale)
+
+    def test_parallel_kalman(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        y = model.yy.values.copy()
+        y[10, 0] = np.nan
+        y[20, :] = np.nan
+
+        lik0 = model.log_lik(p0, y=y, t0=5)
+        for nchunks in [1, 3, 8, y.shape[0]]:
+            lik1 = model.log_lik(p0, y=y, t0=5, filter='parallel_kalman', nchunks=nchunks)
+            assert_allclose(lik0, lik1)
+
     def test_pred(self):
         relative_loc = 'examples/ar1/'
         model_file = pkg_resources.resource_filename('dsge', relative_loc+'ar1.yaml')
@@ -113,3 +221,631 @@ class TestFilter(TestCase):
 
         y1 = ar1.yy.iloc[-1].values
         assert_allclose(pred, [rho*y1, rho**2*y1, rho**3*y1, rho**4*y1, rho**5*y1])
+
+    def test_log_lik_batch(self):
+        relative_loc = 'examples/ar1/'
+        model_file = pkg_resources.resource_filename('dsge', relative_loc+'ar1.yaml')
+        data_file = pkg_resources.resource_filename('dsge', relative_loc+'arma23_sim200.txt')
+        ar1 = DSGE.DSGE.read(model_file)
+        ar1['__data__']['estimation']['data'] = data_file
+
+        ar1 = ar1.compile_model()
+
+        paras = np.array([[0.85, 1.0], [0.5, 0.7], [0.95, 1.3]])
+        lik = ar1.log_lik_batch(paras)
+        assert_allclose(lik, [ar1.log_lik(para) for para in paras])
+
+        lik = ar1.log_lik_batch(paras, filter='kalman_filter')
+        assert_allclose(lik, [ar1.log_lik(para) for para in paras])
+
+        post = ar1.log_post_batch(paras)
+        assert_allclose(post, [ar1.log_post(para) for para in paras])
+
+    def test_steady_state_switch(self):
+        from dsge.StateSpaceModel import StateSpaceModel
+
+        np.random.seed(1848)
+        x = np.zeros(300)
+        for t in range(1, 300):
+            x[t] = 0.9*x[t-1] + np.random.randn()
+        yy = x + np.sqrt(0.5)*np.random.randn(300)
+
+        model = StateSpaceModel(yy,
+                                CC=lambda p: 0.0,
+                                TT=lambda p: p[0],
+                                RR=lambda p: 1.0,
+                                QQ=lambda p: 1.0,
+                                DD=lambda p: 0.0,
+                                ZZ=lambda p: 1.0,
+                                HH=lambda p: [[p[1]]])
+
+        para = [0.9, 0.5]
+        for filt in ['chand_recursion', 'kalman_filter']:
+            lik0 = model.log_lik(para, filter=filt)
+
+            lik1 = model.log_lik(para, filter=filt, ss_tol=1e-12)
+            self.assertAlmostEqual(lik0, lik1, places=8)
+
+            # a loose tolerance switches early and is only approximately right
+            lik2 = model.log_lik(para, filter=filt, ss_tol=1e-2)
+            self.assertNotEqual(lik0, lik2)
+            self.assertAlmostEqual(lik0, lik2, places=0)
+
+    def test_collapse_observations(self):
+        from dsge.StateSpaceModel import StateSpaceModel
+
+        np.random.seed(1848)
+        ns, ny = 3, 12
+        ZZ = np.random.randn(ny, ns)
+        ZZ[:, 2] = ZZ[:, 0]
+        A = np.random.randn(ny, ny)
+        HH = A @ A.T / ny + 0.1*np.eye(ny)
+        yy = np.random.randn(150, ny)
+
+        model = StateSpaceModel(yy,
+                                CC=lambda p: np.zeros(ns),
+                                TT=lambda p: np.diag(p),
+                                RR=lambda p: np.eye(ns),
+                                QQ=lambda p: np.eye(ns),
+                                DD=lambda p: 0.1*np.arange(ny),
+                                ZZ=lambda p: ZZ,
+                                HH=lambda p: HH)
+
+        para = [0.9, 0.5, 0.2]
+        for filt in ['chand_recursion', 'kalman_filter']:
+            lik0 = model.log_lik(para, filter=filt, t0=3)
+            lik1 = model.log_lik(para, filter=filt, t0=3, collapse=True)
+            self.assertAlmostEqual(lik0, lik1, places=8)
+
+        # singular measurement error cannot be collapsed
+        HH[:] = 0.0
+        with self.assertRaisesRegex(ValueError, 'HH is singular'):
+            model.log_lik(para, collapse=True)
+
+    def test_sqrt_kalman(self):
+        from dsge.examples import sw
+
+        sw = sw.compile_model()
+
+        p0 = [0.1657,0.7869,0.5509,0.4312,0.1901,1.3333,1.6064,5.7606,0.72,0.7,1.9,0.65,0.57,0.3,0.5462,2.0443,0.8103,0.0882,0.2247,0.9577,0.2194,0.9767,0.7113,0.1479,0.8895,0.9688,0.5,0.72,0.85,0.4582,0.24,0.5291,0.4526,0.2449,0.141,0.2446]
+        lik0 = sw.log_lik(p0, filter='sqrt_kalman')
+
+        self.assertAlmostEqual(-829.7412615500879, lik0, places=6)
+
+        yy = np.asarray(sw.yy).copy()
+        yy[-3:, :2] = np.nan
+        yy[20, 4] = np.nan
+        lik0 = sw.log_lik(p0, y=yy, filter='kalman_filter')
+        lik1 = sw.log_lik(p0, y=yy, filter='sqrt_kalman')
+        self.assertAlmostEqual(lik0, lik1, places=6)
+
+    def test_univariate_kalman(self):
+        from dsge.examples import sw
+
+        sw = sw.compile_model()
+
+        p0 = [0.1657,0.7869,0.5509,0.4312,0.1901,1.3333,1.6064,5.7606,0.72,0.7,1.9,0.65,0.57,0.3,0.5462,2.0443,0.8103,0.0882,0.2247,0.9577,0.2194,0.9767,0.7113,0.1479,0.8895,0.9688,0.5,0.72,0.85,0.4582,0.24,0.5291,0.4526,0.2449,0.141,0.2446]
+        lik0 = sw.log_lik(p0, filter='univariate_kalman')
+
+        self.assertAlmostEqual(-829.7412615500879, lik0, places=6)
+
+        yy = np.asarray(sw.yy).copy()
+        yy[-3:, :2] = np.nan
+        yy[20, 4] = np.nan
+        lik0 = sw.log_lik(p0, y=yy, filter='kalman_filter')
+        lik1 = sw.log_lik(p0, y=yy, filter='univariate_kalman')
+        self.assertAlmostEqual(lik0, lik1, places=6)
+
+    def test_chand_kalman(self):
+        from dsge.examples import sw
+
+        sw = sw.compile_model()
+
+        p0 = [0.1657,0.7869,0.5509,0.4312,0.1901,1.3333,1.6064,5.7606,0.72,0.7,1.9,0.65,0.57,0.3,0.5462,2.0443,0.8103,0.0882,0.2247,0.9577,0.2194,0.9767,0.7113,0.1479,0.8895,0.9688,0.5,0.72,0.85,0.4582,0.24,0.5291,0.4526,0.2449,0.141,0.2446]
+        lik0 = sw.log_lik(p0, filter='chand_kalman')
+
+        self.assertAlmostEqual(-829.7412615500879, lik0, places=6)
+
+        yy = np.asarray(sw.yy).copy()
+        yy[-3:, :2] = np.nan
+        yy[20, 4] = np.nan
+        yy[50, :] = np.nan
+        lik0 = sw.log_lik(p0, y=yy, filter='kalman_filter')
+        lik1 = sw.log_lik(p0, y=yy)
+        self.assertAlmostEqual(lik0, lik1, places=6)
+
+    def test_minimal_realization(self):
+        from dsge.examples import sw
+        from dsge.filters import minimal_realization
+
+        sw = sw.compile_model()
+
+        p0 = [0.1657,0.7869,0.5509,0.4312,0.1901,1.3333,1.6064,5.7606,0.72,0.7,1.9,0.65,0.57,0.3,0.5462,2.0443,0.8103,0.0882,0.2247,0.9577,0.2194,0.9767,0.7113,0.1479,0.8895,0.9688,0.5,0.72,0.85,0.4582,0.24,0.5291,0.4526,0.2449,0.141,0.2446]
+
+        CC, TT, RR, QQ, DD, ZZ, HH = sw.system_matrices(p0)
+        V = minimal_realization(CC, TT, RR, ZZ, np.zeros(CC.shape), None)[0]
+        self.assertLess(V.shape[1], TT.shape[0])
+
+        lik0 = sw.log_lik(p0, reduce=True)
+        self.assertAlmostEqual(-829.7412615500879, lik0, places=6)
+
+        yy = np.asarray(sw.yy).copy()
+        yy[20, 4] = np.nan
+        lik0 = sw.log_lik(p0, y=yy, reduce=False)
+        lik1 = sw.log_lik(p0, y=yy)
+        self.assertAlmostEqual(lik0, lik1, places=6)
+
+        res0 = sw.kf_everything(p0, y=yy, reduce=False)
+        res1 = sw.kf_everything(p0, y=yy)
+        for name in ['filtered_means', 'smoothed_means', 'smoothed_stds']:
+            assert_allclose(res0[name], res1[name], atol=1e-6)
+
+    def test_unconditional_fast(self):
+        from dsge.examples import sw
+        from dsge.filters import lyapunov_fast
+        from scipy.linalg import solve_discrete_lyapunov
+
+        sw = sw.compile_model()
+
+        p0 = [0.1657,0.7869,0.5509,0.4312,0.1901,1.3333,1.6064,5.7606,0.72,0.7,1.9,0.65,0.57,0.3,0.5462,2.0443,0.8103,0.0882,0.2247,0.9577,0.2194,0.9767,0.7113,0.1479,0.8895,0.9688,0.5,0.72,0.85,0.4582,0.24,0.5291,0.4526,0.2449,0.141,0.2446]
+
+        CC, TT, RR, QQ, DD, ZZ, HH = sw.system_matrices(p0)
+        RQR = RR @ QQ @ RR.T
+        P0 = solve_discrete_lyapunov(TT, RQR)
+
+        P1, converged = lyapunov_fast(TT, RQR, np.zeros_like(TT))
+        self.assertTrue(converged)
+        assert_allclose(P1, P0, atol=1e-10*np.abs(P0).max())
+
+        # warm start at a nearby solution
+        P2, converged = lyapunov_fast(TT, RQR, 1.01*P0)
+        self.assertTrue(converged)
+        assert_allclose(P2, P0, atol=1e-10*np.abs(P0).max())
+
+        S = sw.initial_covariance(TT, RR, QQ, 'unconditional_fast', factor=True)
+        assert_allclose(S @ S.T, P0, atol=1e-10*np.abs(P0).max())
+
+        for filt in ['chand_recursion', 'sqrt_kalman']:
+            lik = sw.log_lik(p0, filter=filt, P0='unconditional_fast')
+            self.assertAlmostEqual(-829.7412615500879, lik, places=6)
+
+    def test_system_matrices_cache(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = np.asarray(dsge.p0())
+        model = dsge.compile_model()
+        self.assertIsNone(model.cache_info())
+
+        lik0 = model.log_lik(p0)
+
+        model.enable_cache(maxsize=2)
+        self.assertEqual(model.log_lik(p0), lik0)
+        self.assertEqual(model.log_lik(p0), lik0)
+        model.kf_everything(p0)
+
+        info = model.cache_info()
+        self.assertEqual(info['system_matrices'], {'hits': 2, 'misses': 1, 'currsize': 1})
+        # kf_everything keeps the unobservable states, so it filters a different
+        # reduced system than log_lik
+        self.assertEqual(info['P0'], {'hits': 1, 'misses': 2, 'currsize': 2})
+
+        # returned matrices are copies
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+        TT[:] = 0.0
+        self.assertEqual(model.log_lik(p0), lik0)
+
+        # least recently used entries are dropped
+        model.log_lik(1.01*p0)
+        model.log_lik(1.02*p0)
+        model.log_lik(p0)
+        self.assertEqual(model.cache_info()['system_matrices']['currsize'], 2)
+        self.assertEqual(model.cache_info()['system_matrices']['misses'], 4)
+
+        model.clear_cache()
+        self.assertEqual(model.cache_info()['system_matrices'],
+                         {'hits': 0, 'misses': 0, 'currsize': 0})
+
+    def test_simulate(self):
+        from dsge.examples import nkmp as dsge
+        from scipy.linalg import solve_discrete_lyapunov
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        ysim = model.simulate(p0, nsim=50, seed=1848)
+        self.assertEqual(ysim.shape, (50, 3))
+        assert_equal(ysim, model.simulate(p0, nsim=50, seed=1848))
+
+        ysim, ssim = model.simulate(p0, nsim=20, npaths=20000, states=True,
+                                    seed=np.random.SeedSequence(1848))
+        self.assertEqual(ysim.shape, (20000, 20, 3))
+        self.assertEqual(ssim.shape, (20000, 20, 11))
+
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+        P0 = solve_discrete_lyapunov(TT, RR @ QQ @ RR.T)
+        V = ZZ @ P0 @ ZZ.T + HH
+        assert_allclose(ysim[:, -1].mean(0), np.ravel(DD), atol=0.02)
+        assert_allclose(np.cov(ysim[:, -1].T), V, atol=0.01)
+
+    def test_pred_batch(self):
+        from scipy.stats import norm
+
+        relative_loc = 'examples/ar1/'
+        model_file = pkg_resources.resource_filename('dsge', relative_loc+'ar1.yaml')
+        data_file = pkg_resources.resource_filename('dsge', relative_loc+'arma23_sim200.txt')
+        ar1 = DSGE.DSGE.read(model_file)
+        ar1['__data__']['estimation']['data'] = data_file
+
+        rho, sigma = ar1.p0()
+
+        ar1 = ar1.compile_model()
+
+        draws = np.array([[rho, sigma], [rho, sigma]])
+        y1 = ar1.yy.iloc[-1].values[0]
+        j = np.arange(1, 5)
+        mean = rho**j * y1
+        sd = sigma*np.sqrt(np.cumsum(rho**(2*(j-1))))
+
+        q = [0.1, 0.5, 0.9]
+        yq = ar1.pred_batch(draws, h=4, quantiles=q)
+        assert_allclose(yq[:, :, 0], norm.ppf(q)[:, None]*sd + mean, rtol=1e-6)
+
+        ysim = ar1.pred_batch(draws, h=4, nsim_per_draw=20000, seed=1848)
+        self.assertEqual(ysim.shape, (2, 20000, 4, 1))
+        assert_allclose(ysim.mean((0, 1))[:, 0], mean, atol=0.05)
+        assert_allclose(ysim.std((0, 1))[:, 0], sd, rtol=0.02)
+
+    def test_impulse_response_batch(self):
+        relative_loc = 'examples/ar1/'
+        model_file = pkg_resources.resource_filename('dsge', relative_loc+'ar1.yaml')
+        data_file = pkg_resources.resource_filename('dsge', relative_loc+'arma23_sim200.txt')
+        ar1 = DSGE.DSGE.read(model_file)
+        ar1['__data__']['estimation']['data'] = data_file
+
+        rho, sigma = ar1.p0()
+
+        ar1 = ar1.compile_model()
+        shock_names = ar1.shock_names
+
+        draws = np.array([[rho, sigma], [0.5, 2.0], [1.5, 1.0]])
+        irf = ar1.impulse_response_batch(draws, h=10, observables=True)
+        self.assertEqual(irf.shape, (3, 1, 11, 1))
+        j = np.arange(11)
+        assert_allclose(irf[0, 0, :, 0], sigma*rho**j)
+        assert_allclose(irf[1, 0, :, 0], 2.0*0.5**j)
+        assert_allclose(irf[2, 0, :, 0], 1.5**j)
+
+        cirf = ar1.impulse_response_batch(draws[:2], h=10, cumulative=True)
+        assert_allclose(cirf, np.cumsum(irf[:2], axis=2))
+        lr = ar1.impulse_response_batch(draws[:2], long_run=True)
+        assert_allclose(lr[:, 0, 0], draws[:2, 1]/(1 - draws[:2, 0]))
+
+        # a unit root has cumulative responses but no long run response
+        unit = np.array([[rho, sigma], [1.0, sigma]])
+        cirf = ar1.impulse_response_batch(unit, h=3, cumulative=True)
+        assert_allclose(cirf[1, 0, :, 0], sigma*np.arange(1, 5))
+        lr = ar1.impulse_response_batch(unit, long_run=True)
+        assert_allclose(lr[0, 0, 0], sigma/(1 - rho))
+        self.assertTrue(np.isnan(lr[1]).all())
+
+        single = ar1.impulse_response([rho, sigma], h=10)
+        assert_allclose(single[shock_names[0]].values, irf[0, 0])
+        self.assertIs(ar1.shock_names, shock_names)
+
+    def test_variance_decomposition(self):
+        from dsge.examples import nkmp as dsge
+        from scipy.linalg import solve_discrete_lyapunov
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+
+        vd = model.variance_decomposition_batch([p0, p0], [1, 4, np.inf],
+                                                observables=True, shares=False)
+        self.assertEqual(vd.shape, (2, 3, 3, 4))
+
+        S = np.zeros_like(TT)
+        for j in range(4):
+            Tj = np.linalg.matrix_power(TT, j)
+            S += Tj @ RR @ QQ @ RR.T @ Tj.T
+        assert_allclose(vd[0, 1].sum(-1), np.diag(ZZ @ S @ ZZ.T + HH))
+
+        P = solve_discrete_lyapunov(TT, RR @ QQ @ RR.T)
+        assert_allclose(vd[1, 2].sum(-1), np.diag(ZZ @ P @ ZZ.T + HH))
+
+        irf = model.impulse_response_batch([p0], h=3, observables=True)[0]
+        assert_allclose(vd[0, 1, :, :-1], (irf**2).sum(1).T)
+
+        shares = model.variance_decomposition(p0, [1, 4, np.inf])
+        self.assertEqual(list(shares), [1, 4, np.inf])
+        assert_allclose(shares[4].sum(1).dropna(), 1.0)
+
+        with self.assertRaises(ValueError):
+            model.variance_decomposition_batch([p0], [2.5])
+
+        model.enable_cache()
+        model.log_lik(p0)
+        model.variance_decomposition_batch([p0], [np.inf])
+        self.assertEqual(model.cache_info()['P0']['currsize'], 1)
+        model.disable_cache()
+
+    def test_historical_decomposition(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        hd = model.historical_decomposition_batch([p0, p0])
+        nobs = model.yy.shape[0]
+        self.assertEqual(hd.shape, (2, nobs, 11, 4))
+
+        smoothed = model.kf_everything(p0, output='means')['smoothed_means']
+        assert_allclose(hd[0].sum(-1), smoothed.values, atol=1e-8)
+        assert_equal(hd[0], hd[1])
+
+        hd = model.historical_decomposition(p0, observables=True)
+        self.assertEqual(list(hd), list(model.shock_names) + ['initial', 'measurement_error'])
+        assert_allclose(sum(hd.values()).values, model.yy.values, atol=1e-8)
+
+    def test_historical_decomposition_scalar_model(self):
+        from dsge.StateSpaceModel import StateSpaceModel
+
+        np.random.seed(1848)
+        yy = np.random.randn(50)
+        model = StateSpaceModel(yy,
+                                CC=lambda p: 0.0,
+                                TT=lambda p: p[0],
+                                RR=lambda p: 1.0,
+                                QQ=lambda p: 1.0,
+                                DD=lambda p: 0.0,
+                                ZZ=lambda p: 1.0,
+                                HH=lambda p: p[1])
+
+        para = [0.9, 0.5]
+        hd = model.historical_decomposition_batch([para])
+        self.assertEqual(hd.shape, (1, 50, 1, 2))
+
+        smoothed = model.kf_everything(para, output='means')['smoothed_means']
+        assert_allclose(hd[0].sum(-1), smoothed.values, atol=1e-8)
+
+        hd = model.historical_decomposition_batch([para], observables=True)
+        assert_allclose(hd[0].sum(-1), yy[:, None], atol=1e-8)
+
+    def test_moments(self):
+        from dsge.examples import nkmp as dsge
+        from scipy.linalg import solve_discrete_lyapunov
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+        P = solve_discrete_lyapunov(TT, RR @ QQ @ RR.T)
+
+        autocov = model.moments_batch([p0, p0], maxlag=3, observables=True)
+        self.assertEqual(autocov.shape, (2, 4, 3, 3))
+        assert_allclose(autocov[0, 0], ZZ @ P @ ZZ.T + HH)
+        assert_allclose(autocov[1, 3], ZZ @ np.linalg.matrix_power(TT, 3) @ P @ ZZ.T)
+
+        mom = model.moments(p0, maxlag=3, observables=True)
+        assert_allclose(mom['std'].values, np.sqrt(np.diag(autocov[0, 0])))
+        assert_allclose(mom['autocorrelation'],
+                        model.moments_batch([p0], 3, observables=True, correlation=True)[0])
+        assert_allclose(np.diagonal(mom['autocorrelation'][0]), 1.0)
+
+    def test_moments_mean(self):
+        from dsge.StateSpaceModel import StateSpaceModel
+
+        model = StateSpaceModel(np.zeros((10, 2)),
+                                CC=lambda p: [0.3, 0.0],
+                                TT=lambda p: np.diag([0.9, 0.5]),
+                                RR=lambda p: np.eye(2),
+                                QQ=lambda p: np.eye(2),
+                                DD=lambda p: [1.0, -1.0],
+                                ZZ=lambda p: [[1.0, 0.5], [0.0, 1.0]],
+                                HH=lambda p: np.zeros((2, 2)))
+
+        assert_allclose(model.moments([], observables=True)['mean'].values, [4.0, -1.0])
+        assert_allclose(model.moments([])['mean'].values, [3.0, 0.0])
+
+    def test_spectrum(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+
+        freqs = np.linspace(0, np.pi, 2001)
+        spec = model.spectrum_batch([p0, p0], freqs)
+        self.assertEqual(spec.shape, (2, 2001, 3, 3))
+
+        for f in [0, 500, 2000]:
+            G = np.linalg.inv(np.eye(TT.shape[0]) - TT*np.exp(-1j*freqs[f]))
+            expected = (ZZ @ G @ RR @ QQ @ RR.T @ G.conj().T @ ZZ.T + HH) / (2*np.pi)
+            assert_allclose(spec[1, f], expected, atol=1e-12)
+
+        # the variance is the integral of the spectrum over [-pi, pi]
+        var = 2*np.trapz(model.spectrum(p0, freqs).real, freqs, axis=0)
+        autocov = model.moments_batch([p0], 0, observables=True)[0, 0]
+        assert_allclose(var, autocov, rtol=1e-4, atol=1e-8)
+
+    def test_whittle(self):
+        relative_loc = 'examples/ar1/'
+        model_file = pkg_resources.resource_filename('dsge', relative_loc+'ar1.yaml')
+        data_file = pkg_resources.resource_filename('dsge', relative_loc+'arma23_sim200.txt')
+        ar1 = DSGE.DSGE.read(model_file)
+        ar1['__data__']['estimation']['data'] = data_file
+
+        rho, sigma = ar1.p0()
+
+        ar1 = ar1.compile_model()
+
+        y = ar1.yy.values[:, 0]
+        T = y.size
+        w = 2*np.pi*np.arange(T)/T
+        d = np.exp(-1j*np.outer(w, np.arange(T))) @ y
+        f = sigma**2/np.abs(1 - rho*np.exp(-1j*w))**2
+        terms = np.log(2*np.pi) + np.log(f) + np.abs(d)**2/(T*f)
+
+        lik = ar1.log_lik([rho, sigma], filter='whittle')
+        assert_allclose(lik, -0.5*terms.sum())
+        self.assertLess(np.abs(lik - ar1.log_lik([rho, sigma])), 2.0)
+
+        band = (0.5, 2.0)
+        inband = (w >= band[0]) & (w <= band[1])
+        lik = ar1.log_lik([rho, sigma], filter='whittle', band=band)
+        assert_allclose(lik, -terms[inband].sum())
+
+        lik = ar1.log_lik([rho, sigma], filter='whittle', nbins=T)
+        assert_allclose(lik, -0.5*terms.sum())
+
+        yy = ar1.yy.copy()
+        yy.iloc[3] = np.nan
+        with self.assertRaises(ValueError):
+            ar1.log_lik([rho, sigma], y=yy, filter='whittle')
+
+    def test_conditional_forecast(self):
+        import pandas as p
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+        CC, TT, RR, QQ, DD, ZZ, HH = model.system_matrices(p0)
+
+        h = 6
+        conditions = p.DataFrame({'int': [1.0, 1.5, 2.0]})
+        ypred = model.conditional_forecast(p0, conditions, h=h)
+        self.assertEqual(ypred.shape, (h, 3))
+        self.assertEqual(ypred.index[0], model.yy.index[-1] + 1)
+        assert_allclose(ypred['int'].values[:3], [1.0, 1.5, 2.0])
+
+        with self.assertRaises(ValueError):
+            model.conditional_forecast(p0, p.DataFrame({'INT': [1.0]}), h=h)
+
+        # the same as smoothing the sample extended with the conditions
+        yy = np.full((model.yy.shape[0] + h, 3), np.nan)
+        yy[:-h] = model.yy.values
+        yy[-h:-h+3, 2] = [1.0, 1.5, 2.0]
+        smoothed = model.kf_everything(p0, y=yy, output='means')['smoothed_means'].values
+        assert_allclose(ypred.values, smoothed[-h:] @ ZZ.T + np.ravel(DD), atol=1e-8)
+
+        # scenarios with different patterns, batched over draws
+        scenarios = np.full((3, 2, 3), np.nan)
+        scenarios[0, :, 2] = [1.0, 1.5]
+        scenarios[1, :, 2] = [0.0, 0.5]
+        scenarios[2, 0, 1] = 2.0
+        ypred = model.conditional_forecast_batch([p0, p0], scenarios, h=4, sd=0.1)
+        self.assertEqual(ypred.shape, (2, 3, 4, 3))
+        for k in range(3):
+            single = model.conditional_forecast(p0, scenarios[k], h=4, sd=0.1)
+            assert_allclose(ypred[1, k], single.values)
+
+    def test_filter_state_update(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        y = model.yy.values.copy()
+        y[-3, 1] = np.nan
+        nobs = y.shape[0]
+
+        lik, state = model.log_lik(p0, y=y, return_state=True)
+        assert_allclose(lik, model.log_lik(p0, y=y))
+        self.assertEqual(state.nobs, nobs)
+
+        _, state = model.log_lik(p0, y=y[:-5], return_state=True, lag=3)
+        new = model.update(state, y[-5:-1])
+        new = model.update(new, y[-1])
+        self.assertEqual(state.nobs, nobs - 5)
+        self.assertEqual(new.nobs, nobs)
+        assert_allclose(new.loglh, lik)
+
+        for kwargs in [{'filter': 'kalman_filter'}, {'ss_tol': 1e-8}, {'nchunks': 2}]:
+            with self.assertRaises(ValueError):
+                model.log_lik(p0, y=y, return_state=True, **kwargs)
+
+        smoothed = model.kf_everything(p0, y=y, output='means')['smoothed_means']
+        recent = model.fixed_lag_smoother(new)
+        assert_equal(recent.index, np.arange(nobs - 3, nobs))
+        assert_allclose(recent.values, smoothed.values[-3:], atol=1e-8)
+
+    def test_chunked_log_lik(self):
+        import os
+        import tempfile
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        y = model.yy.values.copy()
+        y[7, 1] = np.nan
+        lik = model.log_lik(p0, y=y, t0=3)
+
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'yy.npy')
+            np.save(filename, y)
+            mm = np.load(filename, mmap_mode='r')
+
+            assert_allclose(model.log_lik(p0, y=mm, t0=3, chunksize=10), lik)
+            patterns = model._chunk_patterns[2]
+            self.assertEqual(len(patterns), int(np.ceil(y.shape[0]/10)))
+            assert_allclose(model.log_lik(p0, y=mm, t0=3, chunksize=10), lik)
+            self.assertIs(model._chunk_patterns[2], patterns)
+
+            assert_allclose(model.log_lik(p0, y=mm, t0=3), lik)
+            del mm
+
+        blocks = (y[i:i+13] for i in range(0, y.shape[0], 13))
+        assert_allclose(model.log_lik(p0, y=blocks, t0=3), lik)
+
+        # the patterns of the model's own DataFrame are cached too
+        model.log_lik(p0, chunksize=10)
+        patterns = model._chunk_patterns[2]
+        model.log_lik(p0, chunksize=10)
+        self.assertIs(model._chunk_patterns[2], patterns)
+
+        for kwargs in [{'filter': 'sqrt_kalman'}, {'ss_tol': 1e-8}, {'nchunks': 2}]:
+            with self.assertRaises(ValueError):
+                model.log_lik(p0, y=y, chunksize=50, **kwargs)
+
+        # lists are data, not streams of blocks
+        assert_allclose(model.log_lik(p0, y=y.tolist(), t0=3), lik)
+        assert_allclose(model.log_lik(p0, y=y.tolist(), t0=3, filter='kalman_filter'), lik)
+        assert_allclose(model.log_lik(p0, y=y.tolist(), t0=3, chunksize=10), lik)
+
+    def test_missing_data_filter_choice(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        y = model.yy.values.copy()
+        y[5, 1] = np.nan
+
+        lik = model.log_lik(p0, y=y, filter='kalman_filter')
+        assert_allclose(model.log_lik(p0, y=y), lik)
+        assert_allclose(model.log_lik(p0, y=y, ss_tol=1e-10), lik)
+        assert_allclose(model.log_lik_batch([p0, p0], y=y), [lik, lik])
+        assert_allclose(model.log_lik_batch([p0], y=y, ss_tol=1e-10), [lik])
+
+        with self.assertRaises(ValueError):
+            model.log_lik(p0, y=y, filter='chand_kalman', ss_tol=1e-10)
+
+    def test_missing_pattern_in_place_edit(self):
+        from dsge.examples import nkmp as dsge
+
+        p0 = dsge.p0()
+        model = dsge.compile_model()
+
+        lik = model.log_lik(p0)
+        value = model.yy.iloc[5, 1]
+
+        model.yy.iloc[5, 1] = np.nan
+        assert_allclose(model.log_lik(p0), model.log_lik(p0, filter='kalman_filter'))
+        self.assertEqual(model.missing_pattern()[2].min(), 2)
+
+        model.yy.iloc[5, 1] = value
+        assert_allclose(model.log_lik(p0), lik)
+        self.assertEqual(model.missing_pattern()[2].min(), 3)
@@ -0,0 +1,52 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from unittest import TestCase
+
+from dsge import DSGE
+
+import pkg_resources
+
+
+def finite_difference(f, x, h=1e-6):
+    x = np.asarray(x, dtype=float)
+    grad = np.zeros_like(x)
+    for i in range(x.size):
+        step = h*max(abs(x[i]), 1.0)
+        xp, xm = x.copy(), x.copy()
+        xp[i] += step
+        xm[i] -= step
+        grad[i] = (f(xp) - f(xm)) / (2*step)
+    return grad
+
+
+class TestGradient(TestCase):
+
+    def test_ar1(self):
+        relative_loc = 'examples/ar1/'
+        model_file = pkg_resources.resource_filename('dsge', relative_loc+'ar1.yaml')
+        data_file = pkg_resources.resource_filename('dsge', relative_loc+'arma23_sim200.txt')
+        ar1 = DSGE.DSGE.read(model_file)
+        ar1['__data__']['estimation']['data'] = data_file
+
+        ar1 = ar1.compile_model()
+
+        para = [0.85, 1.0]
+        lik, grad = ar1.log_lik_grad(para, return_lik=True)
+
+        self.assertAlmostEqual(lik, ar1.log_lik(para))
+        assert_allclose(grad, finite_difference(ar1.log_lik, para), rtol=1e-5)
+
+    def test_nkmp(self):
+        from dsge.examples import nkmp
+
+        p0 = np.array(nkmp.p0(), dtype=float)
+        model = nkmp.compile_model()
+
+        yy = np.asarray(model.yy).copy()
+        yy[-2, 1] = np.nan
+
+        grad = model.log_lik_grad(p0, y=yy)
+        fd = finite_difference(lambda x: model.log_lik(x, y=yy, filter='kalman_filter'), p0)
+
+        assert_allclose(grad, fd, rtol=1e-4, atol=1e-6*np.abs(fd).max())